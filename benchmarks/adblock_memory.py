@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+
+# -------------------
+# adblock_memory.py
+# -------------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: Measures how much resident memory the bundled easylist.txt
+#              takes up once it is loaded into abpy. Each layout is measured
+#              in a fresh interpreter so the numbers don't bleed into each
+#              other. Resident size is what the OS sees; the Python heap
+#              figure comes from tracemalloc and isn't skewed by allocator
+#              fragmentation.
+#
+#              Usage: python3 benchmarks/adblock_memory.py [easylist.txt]
+
+import sys
+import os
+import gc
+import json
+import tracemalloc
+import subprocess
+
+lib_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib")
+sys.path.insert(0, lib_folder)
+
+from benchmark_utils import rss
+
+# Layouts that can be measured.
+# "objects" keeps one abpy.Rule per line with its regex compiled, which is
+# how rules used to be stored. "compact" is abpy.Filter as it is now, and
+# "compact-compiled" is the same with every regex compiled.
+modes = ("objects", "compact", "compact-compiled")
+
+def measure(mode, fname):
+    import abpy
+    f = open(fname, "r")
+    rules = [rule.rstrip("\n") for rule in f.readlines()]
+    f.close()
+    gc.collect()
+    before = rss()
+    tracemalloc.start()
+    if mode == "objects":
+        keep = []
+        for rule in rules:
+            rule = rule.strip()
+            if not rule or rule.startswith("!") or rule.startswith("[") or "##" in rule or "#@#" in rule:
+                continue
+            try: rule = abpy.Rule(rule)
+            except abpy.RuleSyntaxError: continue
+            rule.regex
+            keep.append(rule)
+    else:
+        keep = abpy.Filter(rules)
+        if mode == "compact-compiled":
+            for rule_id in range(len(keep)):
+                keep.match_rule(rule_id, "")
+    del rules
+    gc.collect()
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    after = rss()
+    return {"mode": mode, "before": before, "after": after, "delta": after - before, "heap": heap}
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == "--mode":
+        print(json.dumps(measure(argv[2], argv[3])))
+        return
+    fname = argv[1] if len(argv) > 1 else os.path.join(lib_folder, "easylist.txt")
+    results = []
+    for mode in modes:
+        output = subprocess.check_output([sys.executable, os.path.realpath(__file__), "--mode", mode, fname])
+        results.append(json.loads(output.decode("utf-8").strip().split("\n")[-1]))
+    for result in results:
+        print("%(mode)-18s rss before %(before)11d  after %(after)11d  delta %(delta)11d  python heap %(heap)11d" % result)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+
+# -----------------
+# adblock_replay.py
+# -----------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: Replays a corpus of requests against the bundled easylist.txt
+#              and hosts file, so that changes to abpy, host_filter and
+#              network can be checked for speed regressions offline.
+#              Reports how long the filters take to build and how much
+#              memory they take, then the p50/p99/max latency and the
+#              throughput of abpy.Filter.match, HostFilter.match and, if
+#              PyQt is available, the whole NetworkAccessManager.decision
+#              path that createRequest goes through.
+#
+#              The corpus is a gzipped file of tab-separated
+#              (URL, element type, first-party host) lines. The bundled
+#              requests.tsv.gz is synthetic, made by --generate from the
+#              rules themselves and a list of popular sites. A recording
+#              of real browsing in the same format can be dropped in its
+#              place.
+#
+#              Usage: python3 benchmarks/adblock_replay.py [--json] [corpus]
+#                     python3 benchmarks/adblock_replay.py --generate [corpus]
+
+import sys
+import os
+import gc
+import re
+import json
+import gzip
+import time
+import random
+import shutil
+import tempfile
+
+benchmarks_folder = os.path.dirname(os.path.realpath(__file__))
+lib_folder = os.path.join(os.path.dirname(benchmarks_folder), "lib")
+sys.path.insert(0, lib_folder)
+
+from benchmark_utils import rss
+
+easylist = os.path.join(lib_folder, "easylist.txt")
+hosts_file = os.path.join(lib_folder, "hosts")
+corpus_file = os.path.join(benchmarks_folder, "requests.tsv.gz")
+
+timer = getattr(time, "perf_counter", time.time)
+
+def read_rules(fname):
+    f = open(fname, "r")
+    try: return [rule.rstrip("\n") for rule in f.readlines()]
+    finally: f.close()
+
+def read_corpus(fname):
+    f = gzip.open(fname, "rb")
+    try: lines = f.read().decode("utf-8").split("\n")
+    finally: f.close()
+    return [tuple(line.split("\t")) for line in lines if line]
+
+def write_corpus(fname, requests):
+    f = gzip.open(fname, "wb")
+    try: f.write("".join(["\t".join(request) + "\n" for request in requests]).encode("utf-8"))
+    finally: f.close()
+
+# Corpus generation.
+# Pages on popular sites load their own scripts, stylesheets and images,
+# a few shared CDNs, and ads and trackers taken from the rules themselves.
+sites = ("google.com", "youtube.com", "facebook.com", "wikipedia.org", "amazon.com", "reddit.com",
+         "twitter.com", "ebay.com", "imdb.com", "bbc.co.uk", "cnn.com", "nytimes.com",
+         "theguardian.com", "dailymail.co.uk", "stackoverflow.com", "github.com", "yahoo.com",
+         "tumblr.com", "deviantart.com", "wikia.com", "huffingtonpost.com", "espn.go.com",
+         "weather.com", "news.com.au", "abc.net.au", "lemonde.fr", "spiegel.de", "wsj.com",
+         "washingtonpost.com", "forbes.com", "bloomberg.com", "cnet.com", "ign.com",
+         "gamespot.com", "imgur.com", "flickr.com", "vimeo.com", "dailymotion.com",
+         "craigslist.org", "yelp.com")
+cdns = ("ajax.googleapis.com", "fonts.googleapis.com", "cdnjs.cloudflare.com",
+        "code.jquery.com", "maxcdn.bootstrapcdn.com", "s3.amazonaws.com")
+words = ("static", "assets", "img", "images", "js", "css", "media", "content", "uploads",
+         "2014", "09", "article", "story", "thumb", "large", "main", "app", "vendor",
+         "widget", "player", "common", "lib", "v2", "build", "dist", "news", "sports")
+extensions = {"script": ".js", "stylesheet": ".css", "image": ".png", "other": ""}
+
+RE_RULE_HOST = re.compile(r"^\|\|([a-z0-9-]+(?:\.[a-z0-9-]+)+)\^")
+RE_RULE_PATH = re.compile(r"^/[a-z0-9_/.-]+$")
+
+def random_path(rng, element_type):
+    path = "/" + "/".join(rng.choice(words) for i in range(rng.randint(1, 4)))
+    path += "/" + rng.choice(words) + str(rng.randint(0, 999)) + extensions.get(element_type, "")
+    if rng.random() < 0.3:
+        path += "?v=%d" % (rng.randint(0, 99999),)
+    return path
+
+def generate(seed=0, pages=600):
+    rng = random.Random(seed)
+    rules = read_rules(easylist)
+    ad_hosts = [m.group(1) for m in (RE_RULE_HOST.match(rule) for rule in rules) if m]
+    ad_paths = [rule for rule in rules if RE_RULE_PATH.match(rule)]
+    import host_filter
+    tracker_hosts = sorted(host_filter.read_hosts_files([hosts_file]))
+    requests = []
+    for i in range(pages):
+        site = rng.choice(sites)
+        host = rng.choice(("www.", "", "m.")) + site
+        requests.append(("http://%s%s" % (host, random_path(rng, "document")), "document", host))
+        for j in range(rng.randint(10, 50)):
+            element_type = rng.choice(("script", "stylesheet", "image", "image", "image", "other", "xmlhttprequest", "subdocument"))
+            roll = rng.random()
+            if roll < 0.55:
+                request_host = rng.choice((host, "static." + site, "img." + site))
+                url = "http://%s%s" % (request_host, random_path(rng, element_type))
+            elif roll < 0.7:
+                url = "https://%s%s" % (rng.choice(cdns), random_path(rng, element_type))
+            elif roll < 0.8:
+                url = "http://%s%s" % (rng.choice(ad_hosts), random_path(rng, element_type))
+            elif roll < 0.9:
+                url = "http://%s%s" % (rng.choice(tracker_hosts), random_path(rng, element_type))
+            else:
+                url = "http://%s%s%s%d" % (rng.choice((host, "static." + site)), rng.choice(ad_paths), rng.choice(words), rng.randint(0, 999))
+            requests.append((url, element_type, host))
+    return requests
+
+# Measurement.
+def percentile(times, fraction):
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+def latency(name, function, requests):
+    function(*requests[0])
+    times = []
+    blocked = 0
+    start = timer()
+    for request in requests:
+        t = timer()
+        result = function(*request)
+        times.append(timer() - t)
+        if result:
+            blocked += 1
+    total = timer() - start
+    times.sort()
+    return {"name": name, "requests": len(requests), "blocked": blocked,
+            "p50_us": percentile(times, 0.5) * 1e6, "p99_us": percentile(times, 0.99) * 1e6,
+            "max_us": times[-1] * 1e6, "per_second": len(requests) / total if total else 0.0}
+
+def run(corpus):
+    import abpy
+    import host_filter
+    requests = read_corpus(corpus)
+    results = {"corpus": os.path.basename(corpus), "requests": len(requests), "builds": [], "matches": []}
+
+    rules = read_rules(easylist)
+    gc.collect()
+    before = rss()
+    start = timer()
+    adblock_filter = abpy.Filter(rules)
+    build = timer() - start
+    del rules
+    gc.collect()
+    results["builds"].append({"name": "abpy.Filter", "rules": len(adblock_filter), "seconds": build, "rss_delta": rss() - before})
+
+    tmp = tempfile.mkdtemp()
+    try:
+        compiled = os.path.join(tmp, "hosts.bin")
+        start = timer()
+        host_filter.compile_domains(host_filter.read_hosts_files([hosts_file]), compiled)
+        build = timer() - start
+        before = rss()
+        host_rules = host_filter.HostFilter(compiled)
+        results["builds"].append({"name": "host_filter.HostFilter", "rules": len(host_rules), "seconds": build, "rss_delta": rss() - before})
+
+        # common.registrableDomain needs Qt, so sites are told apart by
+        # their last two labels here.
+        def third_party(url, first_party):
+            host = abpy.urlsplit(url).hostname or ""
+            return host.split(".")[-2:] != first_party.split(".")[-2:]
+        parties = [third_party(url, first_party) for url, element_type, first_party in requests]
+        adblock_requests = [(url, element_type, first_party, parties[i]) for i, (url, element_type, first_party) in enumerate(requests)]
+        results["matches"].append(latency("abpy.Filter.match", lambda url, element_type, first_party, party: adblock_filter.match(url, element_type, first_party=first_party, third_party=party), adblock_requests))
+        results["matches"].append(latency("host_filter.HostFilter.match", lambda url, element_type, first_party: host_rules.match(abpy.urlsplit(url).hostname), requests))
+        results["matches"].append(decision_latency(adblock_filter, host_rules, requests))
+        host_rules.close()
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+# The decision path needs PyQt for QUrl and for network itself.
+def decision_latency(adblock_filter, host_rules, requests):
+    try:
+        from PyQt5.QtCore import QCoreApplication, QUrl
+    except ImportError:
+        return {"name": "network.NetworkAccessManager.decision", "skipped": "PyQt5 is not available"}
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    import filtering
+    import network
+    filtering.adblock_filter = adblock_filter
+    filtering.host_rules = host_rules
+    manager = network.NetworkAccessManager()
+    urls = [(QUrl(url), url, element_type, first_party) for url, element_type, first_party in requests]
+    def decide(url, urlString, element_type, first_party):
+        return manager.decision(url, urlString, "", element_type, first_party)
+    cold = latency("network.NetworkAccessManager.decision (cold)", lambda *request: (network.decision_cache.clear(), decide(*request))[1], urls)
+    warm = latency("network.NetworkAccessManager.decision", decide, urls)
+    warm["cold"] = cold
+    return warm
+
+def report(results):
+    print("Corpus: %(corpus)s, %(requests)d requests" % results)
+    for build in results["builds"]:
+        print("%(name)-45s %(rules)8d rules  built in %(seconds)8.3fs  rss +%(rss_delta)d" % build)
+    for match in results["matches"]:
+        for match in (match, match.get("cold")):
+            if not match:
+                continue
+            if "skipped" in match:
+                print("%(name)-45s skipped: %(skipped)s" % match)
+                continue
+            print("%(name)-45s p50 %(p50_us)8.1fus  p99 %(p99_us)8.1fus  max %(max_us)9.1fus  %(per_second)9.0f/s  %(blocked)d blocked" % match)
+
+def main(argv):
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    corpus = args[0] if args else corpus_file
+    if "--generate" in argv:
+        write_corpus(corpus, generate())
+        return
+    results = run(corpus)
+    if "--json" in argv:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+if __name__ == "__main__":
+    main(sys.argv)
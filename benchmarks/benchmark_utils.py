@@ -0,0 +1,22 @@
+#! /usr/bin/env python3
+
+# ------------------
+# benchmark_utils.py
+# ------------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: Helpers shared by the benchmark scripts.
+
+import sys
+import os
+
+# Resident set size of this process in bytes.
+def rss():
+    try: f = open("/proc/self/statm", "r")
+    except:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+    else:
+        try: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        finally: f.close()
@@ -23,7 +23,7 @@ def main():
         elif key.startswith("General/"):
             settings5.setValue(chop(key, "General/"), settings4.value(key))
 
-    settings5.sync()
+    settings5.flush()
 
     keys = data4.allKeys()
     for key in keys:
@@ -33,7 +33,7 @@ def main():
         elif key.startswith("General/"):
             data5.setValue(chop(key, "General/"), data4.value(key))
 
-    data5.sync()
+    data5.flush()
 
 if __name__ == "__main__":
     main()
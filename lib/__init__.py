@@ -1,3 +1,3 @@
 #!/usr/bin/env python3
 
-__all__ = ["nimbus", "abpy", "browser", "clear_history_dialog", "common", "custom_widgets", "data", "extension_server", "filtering", "geolocation", "network", "settings", "settings_dialog", "status_bar", "translate", "paths"]
+__all__ = ["nimbus", "abpy", "browser", "clear_history_dialog", "common", "cookies", "custom_widgets", "data", "extension_server", "filtering", "geolocation", "history_store", "host_filter", "network", "settings", "settings_dialog", "status_bar", "subscriptions", "translate", "paths"]
@@ -14,13 +14,33 @@ directly with an array of AdBlock Plus rules, instead of using a file object.
 from __future__ import print_function
 import re
 import sys
+import time
+from array import array
+try: from urllib.parse import urlsplit
+except ImportError: from urlparse import urlsplit
 
 if sys.version_info[0] > 2:
     def unicode(*args, **kwargs):
         return str(*args, **kwargs)
+    intern = sys.intern
+
+timer = getattr(time, 'perf_counter', time.time)
 
 RE_TOK = re.compile('\W')
 
+# A keyword is a run of at least three keyword characters that is bounded on
+# both sides by something other than a keyword character or a wildcard, so
+# every URL the rule matches is guaranteed to contain it as a whole token.
+RE_KEYWORD = re.compile(r'[^a-z0-9%*][a-z0-9%]{3,}(?=[^a-z0-9%*])')
+RE_URL_TOK = re.compile(r'[a-z0-9%]{3,}')
+
+# Matches ||host^ rules, which block a host and all of its subdomains.
+RE_HOST_RULE = re.compile(r'^\|\|([a-z0-9-]+(?:\.[a-z0-9-]+)+)\^$')
+
+# Bump this whenever the layout returned by Filter.snapshot() or
+# CosmeticFilter.snapshot() changes.
+SNAPSHOT_VERSION = 4
+
 
 MAP_RE = (('\|\|','(//|\.)'),
           ('\^', r'[/\\:+!@#\$^\^&\*\(\)\|]'),
@@ -38,82 +58,712 @@ TYPE_OPTS = (('script', 'external scripts loaded via HTML script tag'),
              ('subdocument', 'embedded pages, usually included via HTML frames'),
              ('document', 'the page itself (only exception rules can be applied to the page)'),
              ('elemhide', 'for exception rules only, similar to document but only disables element hiding rules on the page rather than all filter rules (Adblock Plus 1.2 and higher required)'),
-             ('other', 'types of requests not covered in the list above'))
+             ('other', 'types of requests not covered in the list above'),
+             ('popup', 'pages opened in a new window or tab'))
 TYPE_OPT_IDS = [x[0] for x in TYPE_OPTS]
 
+# Type options packed into bitmasks, one bit per entry in TYPE_OPTS.
+TYPE_OPT_BITS = dict((opt, 1 << i) for i, opt in enumerate(TYPE_OPT_IDS))
+OTHER_BIT = TYPE_OPT_BITS['other']
+
+# Rules without type options apply to every type except these.
+DEFAULT_TYPE_MASK = sum(TYPE_OPT_BITS.values()) & ~(TYPE_OPT_BITS['document'] |
+                                                    TYPE_OPT_BITS['elemhide'] |
+                                                    TYPE_OPT_BITS['popup'])
+
+# Rule flags, packed into one byte per rule.
+THIRD_PARTY = 1     # $third-party
+FIRST_PARTY = 2     # $~third-party
+EXCEPTION = 4       # @@
+REMOVED = 8         # taken out by Filter.updated()
+
+def parse_type_opts(optstring):
+    """Returns the (matched, excluded) type bitmasks of an option string."""
+    matched = excluded = 0
+    for o in optstring.split(','):
+        if o.startswith('~') and o[1:] in TYPE_OPT_BITS:
+            excluded |= TYPE_OPT_BITS[o[1:]]
+        elif o in TYPE_OPT_BITS:
+            matched |= TYPE_OPT_BITS[o]
+    return matched or DEFAULT_TYPE_MASK, excluded
+
+def parse_domain_opt(optstring):
+    """Returns the (included, excluded) domains of a $domain= option."""
+    for o in optstring.split(','):
+        if o.startswith('domain='):
+            domains = [d for d in o[7:].lower().split('|') if d]
+            return (tuple(d for d in domains if not d.startswith('~')),
+                    tuple(d[1:] for d in domains if d.startswith('~')))
+    return (), ()
+
+def match_type_mask(matched, excluded, elementtype=None):
+    if elementtype:
+        bit = TYPE_OPT_BITS.get(elementtype, OTHER_BIT)
+        if excluded & bit or not matched & bit:
+            return False
+    return True
+
+def pattern_to_regex(pattern):
+    re_str = re.escape(pattern)
+    for m in MAP_RE:
+        re_str = re_str.replace(*m)
+    return re.compile(re_str)
+
+def parent_domains(host):
+    """Returns host followed by each of its parent domains."""
+    domains = []
+    host = host.lower().rstrip('.')
+    while host:
+        domains.append(host)
+        host = host.partition('.')[2]
+    return domains
+
+
+def parse_rule(rul):
+    """Returns the Rule for one line of a rule file, or None if the line is
+    blank, a comment, an element hiding rule or not a valid rule."""
+    rul = rul.strip()
+    if not rul or rul.startswith('!') or rul.startswith('['): # Comment
+        return None
+    if '##' in rul or '#@#' in rul: # HTML rule
+        return None
+    try:
+        return Rule(rul)
+    except RuleSyntaxError:
+        print('syntax error in ', rul)
+        return None
+
+def rule_text(pattern, optstring, exception):
+    rule_str = pattern
+    if optstring:
+        rule_str += '$' + optstring
+    if exception:
+        rule_str = '@@' + rule_str
+    return rule_str
+
 class Rule(object):
     def __init__(self, rule_str):
         self.rule_str = rule_str.strip()
+        self.exception = self.rule_str.startswith('@@')
+        rule_str = self.rule_str[2:] if self.exception else self.rule_str
         if '$' in rule_str:
             try:
                 self.pattern, self.optstring = rule_str.split('$')
             except ValueError:
                 raise RuleSyntaxError()
         else:
-            self.pattern = self.rule_str
+            self.pattern = rule_str
             self.optstring = ''
-        self.regex = self._to_regex()
+        host = RE_HOST_RULE.match(self.pattern.lower())
+        self.host = host.group(1) if host else None
+        self._regex = None
+        self.type_mask, self.excluded_mask = parse_type_opts(self.optstring)
+        self.domains, self.excluded_domains = parse_domain_opt(self.optstring)
         opts = self.optstring.split(',')
-        self.excluded_elements = []
-        self.matched_elements = []
-        for o in opts:
-            if o.startswith('~') and o[1:] in TYPE_OPT_IDS:
-                self.excluded_elements.append(o)
-            elif o in TYPE_OPT_IDS:
-                self.matched_elements.append(o)
-        if self.matched_elements == []:
-            self.matched_elements = TYPE_OPT_IDS
+        self.flags = EXCEPTION if self.exception else 0
+        if 'third-party' in opts:
+            self.flags |= THIRD_PARTY
+        elif '~third-party' in opts:
+            self.flags |= FIRST_PARTY
+
+    # The regex is only compiled the first time the rule is a candidate for
+    # a URL; most rules never are.
+    @property
+    def regex(self):
+        if self._regex is None:
+            self._regex = self._to_regex()
+        return self._regex
 
     def get_tokens(self):
         return RE_TOK.split(self.pattern)
 
+    def get_keywords(self):
+        return [kw[1:] for kw in RE_KEYWORD.findall(self.pattern.lower())]
+
+    def match_type(self, elementtype=None):
+        return match_type_mask(self.type_mask, self.excluded_mask, elementtype)
+
     def match(self, url, elementtype=None):
-        if elementtype:
-            if elementtype in self.excluded_elements or\
-                    (elementtype not in self.matched_elements and\
-                         'other' not in self.matched_elements):
-                return False
+        if not self.match_type(elementtype):
+            return False
         return self.regex.search(url)
 
     def _to_regex(self):
-        re_str = re.escape(self.pattern)
-        for m in MAP_RE:
-            re_str = re_str.replace(*m)
-        return re.compile(re_str)
+        return pattern_to_regex(self.pattern)
     
     def __unicode__(self):
         return self.rule_str
 
 
+class RuleTables(object):
+    """Lookup tables for one kind of rule, either blocking or exception.
+
+    Rules are partitioned so that a request only looks at the ones that can
+    apply to it: ||host^ rules by host, $domain= rules by the first-party
+    domains they are limited to, and the rest by keyword, in separate
+    indexes for rules that apply to either party, only to third-party
+    requests and only to first-party requests.
+    """
+    def __init__(self):
+        self.hosts = {}
+        self.domains = {}
+        self.index = {}
+        self.third_party = {}
+        self.first_party = {}
+
+    def __len__(self):
+        return sum(len(ids) for table in self.tables() for ids in table.values())
+
+    def tables(self):
+        return (self.hosts, self.domains, self.index, self.third_party, self.first_party)
+
+    def copy(self):
+        """Returns a copy that shares the ID arrays with this one."""
+        new = self.__class__()
+        (new.hosts, new.domains, new.index, new.third_party,
+         new.first_party) = [dict(table) for table in self.tables()]
+        return new
+
+    def keyword_index(self, flags):
+        if flags & THIRD_PARTY:
+            return self.third_party
+        if flags & FIRST_PARTY:
+            return self.first_party
+        return self.index
+
+    def snapshot(self):
+        return [dict((k, v.tobytes()) for k, v in table.items())
+                for table in self.tables()]
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        def ids(data):
+            a = array('I')
+            a.frombytes(data)
+            return a
+        self = cls()
+        (self.hosts, self.domains, self.index, self.third_party,
+         self.first_party) = [dict((k, ids(v)) for k, v in table.items())
+                              for table in snapshot]
+        return self
+
+
+class RuleProfile(object):
+    """Per-rule counters kept by a Filter while profiling is enabled.
+
+    For every rule it records how often it was a candidate for a request
+    (looked up through one of the tables), how often it matched, and how
+    much time was spent in its regex.
+    """
+    def __init__(self, count):
+        self.candidates = array('L', [0]) * count
+        self.hits = array('L', [0]) * count
+        self.times = array('d', [0.0]) * count
+        self.requests = 0
+        self.started = time.time()
+
+    def rule_stats(self, rule_id):
+        return {'candidates': self.candidates[rule_id],
+                'hits': self.hits[rule_id],
+                'time': self.times[rule_id]}
+
+
 class Filter(object):
+    """Matches URLs against a list of rules.
+
+    Every rule is filed under a single keyword, the one that the fewest other
+    rules could also be filed under. URLs are cut into tokens in one pass and
+    each token is looked up in the keyword index, so a request only checks the
+    handful of rules whose keyword it actually contains. Rules that have no
+    usable keyword are kept under the empty keyword and checked every time.
+
+    Rules of the form ||host^ never reach the keyword index. They are kept in
+    a table keyed by host and resolved by looking up the request's host and
+    each of its parent domains, without running any regex.
+
+    Blocking and @@ exception rules are kept in separate RuleTables, which
+    also split rules by party and by $domain=. Exceptions are only searched
+    once a blocking rule has matched.
+
+    No Rule objects are kept. A rule is an integer ID into parallel arrays
+    of interned pattern and option strings, packed type masks and flags and
+    lazily compiled regexes, and all tables map to array('I') lists of IDs.
+
+    enable_profiling() makes match() keep a RuleProfile. While it is off,
+    the only cost is one check per candidate rule.
+    """
     def __init__(self, f):
-        self.index = {}
+        self.blocking = RuleTables()
+        self.exceptions = RuleTables()
+        self.patterns = []
+        self.optstrings = []
+        self.type_masks = array('H')
+        self.excluded_masks = array('H')
+        self.flags = array('B')
+        self.rule_domains = {}
+        keywords = []
+        counts = {}
         for rul in f:
-            if rul.startswith('!'): # Comment 
-                continue 
-            if '##' in rul: # HTML rule
+            rule = parse_rule(rul)
+            if rule is None:
                 continue
-            try:
-                rule = Rule(rul)
-            except RuleSyntaxError:
-                print('syntax error in ', rul)
-            for tok in rule.get_tokens():
-                if len(tok) > 2:
-                    if tok not in self.index:
-                        self.index[tok] = []
-                    self.index[tok].append(rule)
+            placed = self._add_rule(rule)
+            if placed is None:
+                continue
+            for kw in set(placed[2]):
+                counts[kw] = counts.get(kw, 0) + 1
+            keywords.append(placed)
+        for rule_id, index, kws in keywords:
+            keyword = ''
+            if kws:
+                keyword = min(kws, key=lambda kw: (counts[kw], -len(kw)))
+            index.setdefault(keyword, array('I')).append(rule_id)
+        self.regexes = [None] * len(self.patterns)
+        self.profile = None
 
-    def match(self, url, elementtype=None):
-        tokens = RE_TOK.split(url)
-        for tok in tokens:
-            if len(tok) > 2:
-                if tok in self.index:
-                    for rule in self.index[tok]:
-                        if rule.match(url, elementtype=elementtype):
-                            return rule
+    def _add_rule(self, rule, bucket=None):
+        """Gives rule an ID and files it under its host or $domain= domains.
+        Keyword rules are left for the caller to file, and (ID, keyword
+        index, keywords) is returned for them."""
+        if bucket is None:
+            bucket = lambda table, key: table.setdefault(key, array('I'))
+        rule_id = len(self.patterns)
+        self.patterns.append(intern(rule.pattern))
+        self.optstrings.append(intern(rule.optstring))
+        self.type_masks.append(rule.type_mask)
+        self.excluded_masks.append(rule.excluded_mask)
+        self.flags.append(rule.flags)
+        tables = self.exceptions if rule.exception else self.blocking
+        if rule.domains or rule.excluded_domains:
+            self.rule_domains[rule_id] = (rule.domains, rule.excluded_domains)
+        if rule.host:
+            bucket(tables.hosts, rule.host).append(rule_id)
+            return None
+        if rule.domains:
+            for d in rule.domains:
+                bucket(tables.domains, d).append(rule_id)
+            return None
+        return rule_id, tables.keyword_index(rule.flags), rule.get_keywords()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def rule_str(self, rule_id):
+        return rule_text(self.patterns[rule_id], self.optstrings[rule_id],
+                         self.flags[rule_id] & EXCEPTION)
+
+    def rule_ids(self):
+        """Maps the text of every rule to its ID."""
+        flags = self.flags
+        return dict((self.rule_str(rule_id), rule_id)
+                    for rule_id in range(len(self))
+                    if not flags[rule_id] & REMOVED)
+
+    def updated(self, added=(), removed=()):
+        """Returns a copy of the filter with the rules in added put in and
+        the ones in removed taken out, without rebuilding the rest.
+
+        This filter is left untouched, so it can go on matching requests
+        while the copy is made and then be swapped for it. The copy shares
+        every table entry it doesn't change. Removed rules keep their IDs
+        but are dropped from the tables and flagged REMOVED; they only go
+        away for good when the filter is next built from scratch. New
+        keyword rules are filed under whichever of their keywords has the
+        fewest rules so far.
+        """
+        new = self.__class__.__new__(self.__class__)
+        new.patterns = list(self.patterns)
+        new.optstrings = list(self.optstrings)
+        new.type_masks = array('H', self.type_masks)
+        new.excluded_masks = array('H', self.excluded_masks)
+        new.flags = array('B', self.flags)
+        new.rule_domains = dict(self.rule_domains)
+        new.blocking = self.blocking.copy()
+        new.exceptions = self.exceptions.copy()
+        new.profile = None
+        # Shared arrays are copied the first time they are written to.
+        copied = set()
+        def bucket(table, key):
+            if (id(table), key) not in copied:
+                table[key] = array('I', table.get(key, ()))
+                copied.add((id(table), key))
+            return table[key]
+        ids = new.rule_ids()
+        for rul in removed:
+            rule = parse_rule(rul)
+            if rule is None:
+                continue
+            rule_id = ids.pop(rule_text(rule.pattern, rule.optstring,
+                                        rule.exception), None)
+            if rule_id is None:
+                continue
+            tables = new.exceptions if rule.exception else new.blocking
+            if rule.host:
+                places = [(tables.hosts, rule.host)]
+            elif rule.domains:
+                places = [(tables.domains, d) for d in rule.domains]
+            else:
+                index = tables.keyword_index(rule.flags)
+                places = [(index, kw) for kw in set(rule.get_keywords() + [''])]
+            for table, key in places:
+                if rule_id in table.get(key, ()):
+                    rule_ids = bucket(table, key)
+                    rule_ids.remove(rule_id)
+                    if not rule_ids:
+                        del table[key]
+            new.flags[rule_id] |= REMOVED
+            new.rule_domains.pop(rule_id, None)
+        for rul in added:
+            rule = parse_rule(rul)
+            if rule is None:
+                continue
+            if rule_text(rule.pattern, rule.optstring, rule.exception) in ids:
+                continue
+            placed = new._add_rule(rule, bucket)
+            ids[rule_text(rule.pattern, rule.optstring, rule.exception)] = len(new) - 1
+            if placed is None:
+                continue
+            rule_id, index, kws = placed
+            keyword = ''
+            if kws:
+                keyword = min(kws, key=lambda kw: (len(index.get(kw, ())), -len(kw)))
+            bucket(index, keyword).append(rule_id)
+        new.regexes = list(self.regexes) + [None] * (len(new) - len(self))
+        return new
+
+    def snapshot(self):
+        """Returns the built tables as plain data that marshal can store."""
+        return {'version': SNAPSHOT_VERSION,
+                'itemsize': array('I').itemsize,
+                'patterns': self.patterns,
+                'optstrings': self.optstrings,
+                'type_masks': self.type_masks.tobytes(),
+                'excluded_masks': self.excluded_masks.tobytes(),
+                'flags': self.flags.tobytes(),
+                'rule_domains': self.rule_domains,
+                'blocking': self.blocking.snapshot(),
+                'exceptions': self.exceptions.snapshot()}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuilds a Filter from Filter.snapshot() output without parsing or
+        compiling anything. Returns None if the snapshot is from another
+        version or platform."""
+        if not isinstance(snapshot, dict) or\
+                snapshot.get('version') != SNAPSHOT_VERSION or\
+                snapshot.get('itemsize') != array('I').itemsize:
+            return None
+        def unpack(data, typecode):
+            a = array(typecode)
+            a.frombytes(data)
+            return a
+        self = cls.__new__(cls)
+        self.patterns = [intern(p) for p in snapshot['patterns']]
+        self.optstrings = [intern(o) for o in snapshot['optstrings']]
+        self.type_masks = unpack(snapshot['type_masks'], 'H')
+        self.excluded_masks = unpack(snapshot['excluded_masks'], 'H')
+        self.flags = unpack(snapshot['flags'], 'B')
+        self.rule_domains = snapshot['rule_domains']
+        self.blocking = RuleTables.from_snapshot(snapshot['blocking'])
+        self.exceptions = RuleTables.from_snapshot(snapshot['exceptions'])
+        self.regexes = [None] * len(self.patterns)
+        self.profile = None
+        return self
+
+    def match_options(self, rule_id, elementtype=None, first_parties=None,
+                      third_party=None):
+        """Checks everything about a rule except its pattern."""
+        if not match_type_mask(self.type_masks[rule_id],
+                               self.excluded_masks[rule_id], elementtype):
+            return False
+        if third_party is not None:
+            flags = self.flags[rule_id]
+            if flags & THIRD_PARTY and not third_party or\
+                    flags & FIRST_PARTY and third_party:
+                return False
+        if rule_id in self.rule_domains:
+            included, excluded = self.rule_domains[rule_id]
+            # A rule limited to some sites can't be said to apply when the
+            # page's site is unknown.
+            if first_parties is None:
+                return not included
+            if included and not [d for d in included if d in first_parties]:
+                return False
+            if excluded and [d for d in excluded if d in first_parties]:
+                return False
+        return True
+
+    def match_rule(self, rule_id, url, elementtype=None, first_parties=None,
+                   third_party=None):
+        if not self.match_options(rule_id, elementtype, first_parties,
+                                  third_party):
+            return False
+        return self.regex(rule_id).search(url)
+
+    def regex(self, rule_id):
+        regex = self.regexes[rule_id]
+        if regex is None:
+            regex = self.regexes[rule_id] = pattern_to_regex(self.patterns[rule_id])
+        return regex
+
+    def match_tables(self, tables, url, tokens, elementtype, hosts,
+                     first_parties, third_party):
+        """Returns the ID of the first rule in tables that matches, or None."""
+        # This runs for every request, so the checks from match_options are
+        # inlined here, cheapest first: type bits, party flags, $domain=,
+        # and only then the regex.
+        type_masks = self.type_masks
+        excluded_masks = self.excluded_masks
+        flags = self.flags
+        rule_domains = self.rule_domains
+        bit = TYPE_OPT_BITS.get(elementtype, OTHER_BIT) if elementtype else 0
+        if third_party is None:
+            wrong_party = 0
+        else:
+            wrong_party = FIRST_PARTY if third_party else THIRD_PARTY
+        profile = self.profile
+        def first(ids, check_regex=True):
+            for rule_id in ids:
+                if profile is not None:
+                    profile.candidates[rule_id] += 1
+                if bit and (excluded_masks[rule_id] & bit or
+                            not type_masks[rule_id] & bit):
+                    continue
+                if flags[rule_id] & wrong_party:
+                    continue
+                if rule_id in rule_domains:
+                    included, excluded = rule_domains[rule_id]
+                    # A rule limited to some sites can't be said to apply
+                    # when the page's site is unknown.
+                    if first_parties is None:
+                        if included:
+                            continue
+                    else:
+                        if included and not [d for d in included if d in first_parties]:
+                            continue
+                        if excluded and [d for d in excluded if d in first_parties]:
+                            continue
+                if check_regex:
+                    if profile is None:
+                        if not self.regex(rule_id).search(url):
+                            continue
+                    else:
+                        regex = self.regex(rule_id)
+                        start = timer()
+                        found = regex.search(url)
+                        profile.times[rule_id] += timer() - start
+                        if not found:
+                            continue
+                if profile is not None:
+                    profile.hits[rule_id] += 1
+                return rule_id
+        for host in hosts:
+            if host in tables.hosts:
+                rule_id = first(tables.hosts[host], False)
+                if rule_id is not None:
+                    return rule_id
+        if first_parties:
+            for domain in first_parties:
+                if domain in tables.domains:
+                    rule_id = first(tables.domains[domain])
+                    if rule_id is not None:
+                        return rule_id
+        indexes = [tables.index]
+        if third_party or third_party is None:
+            indexes.append(tables.third_party)
+        if not third_party:
+            indexes.append(tables.first_party)
+        for index in indexes:
+            if not index:
+                continue
+            for tok in tokens:
+                if tok in index:
+                    rule_id = first(index[tok])
+                    if rule_id is not None:
+                        return rule_id
+            if '' in index:
+                rule_id = first(index[''])
+                if rule_id is not None:
+                    return rule_id
+
+    def match(self, url, elementtype=None, host=None, first_party=None,
+              third_party=None):
+        """Returns the text of the blocking rule that matches url, or None if
+        no rule does or an exception rule lets it through.
+
+        first_party is the host of the page the request was made from, used
+        for $domain= options and for @@...$document exceptions, which are
+        checked against that host's front page. third_party says whether the
+        request leaves the page's site.
+
+        When first_party is None, rules limited to some sites with $domain=
+        are skipped, blocking and exception rules alike, and rules that only
+        exclude sites (domain=~...) apply. When third_party is None, both
+        $third-party and ~third-party rules apply.
+        """
+        if host is None:
+            try: host = urlsplit(url).hostname or ''
+            except ValueError: host = ''
+        hosts = parent_domains(host)
+        first_parties = parent_domains(first_party) if first_party else None
+        tokens = set(RE_URL_TOK.findall(url.lower()))
+        if self.profile is not None:
+            self.profile.requests += 1
+        rule_id = self.match_tables(self.blocking, url, tokens, elementtype,
+                                    hosts, first_parties, third_party)
+        if rule_id is None:
+            return None
+        if self.match_tables(self.exceptions, url, tokens, elementtype,
+                             hosts, first_parties,
+                             third_party) is not None:
+            return None
+        if first_party:
+            page = 'http://%s/' % (first_party,)
+            if self.match_tables(self.exceptions, page,
+                                 set(RE_URL_TOK.findall(page.lower())),
+                                 'document', first_parties, first_parties,
+                                 False) is not None:
+                return None
+        return self.rule_str(rule_id)
+
+    def enable_profiling(self):
+        if self.profile is None:
+            self.profile = RuleProfile(len(self))
+
+    def disable_profiling(self):
+        self.profile = None
+
+    def profile_stats(self):
+        """Returns the profile as plain data that json can store, or None if
+        profiling is off."""
+        profile = self.profile
+        if profile is None:
+            return None
+        return {'requests': profile.requests,
+                'started': profile.started,
+                'seconds': time.time() - profile.started,
+                'rules': [dict(profile.rule_stats(rule_id),
+                               rule=self.rule_str(rule_id))
+                          for rule_id in range(len(self))
+                          if not self.flags[rule_id] & REMOVED]}
+
+    def pruned_rules(self, min_hits=1, max_time=0.0001):
+        """Returns the text of every rule that was hit at least min_hits times
+        and whose regex took no more than max_time seconds per search on
+        average. Returns None if profiling is off."""
+        profile = self.profile
+        if profile is None:
+            return None
+        rules = []
+        for rule_id in range(len(self)):
+            if self.flags[rule_id] & REMOVED or profile.hits[rule_id] < min_hits:
+                continue
+            if max_time is not None and profile.candidates[rule_id] and\
+                    profile.times[rule_id] / profile.candidates[rule_id] > max_time:
+                continue
+            rules.append(self.rule_str(rule_id))
+        return rules
+
+
+class CosmeticFilter(object):
+    """Element hiding (##) rules, indexed by the domains they apply to.
+
+    Generic rules are kept in one list, since they apply nearly everywhere.
+    Domain-specific rules, ~domain exclusions of generic rules and #@#
+    exceptions are keyed by domain, so working out the selectors for a host
+    only takes a lookup per parent domain.
+    """
+    def __init__(self, f):
+        self.generic = []
+        self.domains = {}
+        self.excluded = {}
+        self.exceptions = {}
+        for rul in f:
+            rul = rul.strip()
+            if rul.startswith('!'):
+                continue
+            if '#@#' in rul:
+                domains, _, selector = rul.partition('#@#')
+                exception = True
+            elif '##' in rul:
+                domains, _, selector = rul.partition('##')
+                exception = False
+            else:
+                continue
+            if not selector:
+                continue
+            selector = intern(selector)
+            domains = [d for d in domains.lower().split(',') if d]
+            include = [d for d in domains if not d.startswith('~')]
+            exclude = tuple(d[1:] for d in domains if d.startswith('~'))
+            if exception:
+                for d in include or ['']:
+                    self.exceptions.setdefault(d, []).append(selector)
+            elif include:
+                for d in include:
+                    self.domains.setdefault(d, []).append((selector, exclude))
+            else:
+                self.generic.append(selector)
+                for d in exclude:
+                    self.excluded.setdefault(d, []).append(selector)
+        if '' in self.exceptions:
+            everywhere = set(self.exceptions.pop(''))
+            self.generic = [s for s in self.generic if s not in everywhere]
+            for d in self.domains:
+                self.domains[d] = [r for r in self.domains[d] if r[0] not in everywhere]
+
+    def __len__(self):
+        return len(self.generic) + sum(len(r) for r in self.domains.values())
+
+    def selectors(self, host):
+        """Returns (generic, specific) selector lists to hide on host.
+
+        generic is self.generic itself unless host has exceptions or
+        exclusions that remove some of it, so callers can tell by identity
+        whether a shared stylesheet built from self.generic still applies.
+        """
+        parents = parent_domains(host)
+        skip = set()
+        for d in parents:
+            skip.update(self.exceptions.get(d, ()))
+            skip.update(self.excluded.get(d, ()))
+        generic = self.generic
+        if skip:
+            generic = [s for s in generic if s not in skip]
+        specific = []
+        for d in parents:
+            for selector, exclude in self.domains.get(d, ()):
+                if selector in skip:
+                    continue
+                if exclude and [e for e in exclude if e in parents]:
+                    continue
+                specific.append(selector)
+        return generic, specific
+
+    def snapshot(self):
+        """Returns the built tables as plain data that marshal can store."""
+        return {'version': SNAPSHOT_VERSION,
+                'generic': self.generic,
+                'domains': self.domains,
+                'excluded': self.excluded,
+                'exceptions': self.exceptions}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuilds a CosmeticFilter from CosmeticFilter.snapshot() output.
+        Returns None if the snapshot is from another version."""
+        if not isinstance(snapshot, dict) or\
+                snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        self = cls.__new__(cls)
+        self.generic = snapshot['generic']
+        self.domains = snapshot['domains']
+        self.excluded = snapshot['excluded']
+        self.exceptions = snapshot['exceptions']
+        return self
 
 
 if __name__ == '__main__':
-    f = Filter(file('easylist.txt'))
+    f = Filter(open('easylist.txt'))
     print('start matching')
-    f.match(sys.argv[1])
+    print(f.match(sys.argv[1]))
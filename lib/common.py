@@ -20,27 +20,27 @@ import settings
 pyqt4 = settings.pyqt4
 if not settings.pyqt4:
     try:
-        from PyQt5.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication
+        from PyQt5.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication, QObject, pyqtSignal as Signal
         from PyQt5.QtGui import QIcon
         from PyQt5.QtWidgets import QApplication
         from PyQt5.QtWebKit import qWebKitVersion
     except:
         try:
-            from PyQt4.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication
+            from PyQt4.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication, QObject, pyqtSignal as Signal
             from PyQt4.QtGui import QIcon, QApplication
             from PyQt4.QtWebKit import qWebKitVersion
         except:
-            from PySide.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication
+            from PySide.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication, QObject, Signal
             from PySide.QtGui import QIcon, QApplication
             from PySide.QtWebKit import qWebKitVersion
         pyqt4 = True
 else:
     try:
-        from PyQt4.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication
+        from PyQt4.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication, QObject, pyqtSignal as Signal
         from PyQt4.QtGui import QIcon, QApplication
         from PyQt4.QtWebKit import qWebKitVersion
     except:
-        from PySide.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication
+        from PySide.QtCore import qVersion, QLocale, QUrl, QEvent, QCoreApplication, QObject, Signal
         from PySide.QtGui import QIcon, QApplication
         from PySide.QtWebKit import qWebKitVersion
     pyqt4 = True
@@ -120,6 +120,24 @@ if os.path.isfile(tlds_file):
 def topLevelDomains():
     return tlds
 
+# Second-level labels that country code TLDs commonly register under,
+# as in example.co.uk or example.com.au.
+second_level_domains = ("co", "com", "net", "org", "gov", "edu", "ac", "or", "ne", "go")
+
+# Returns the part of a host that a site registers, e.g. "example.co.uk"
+# for "www.example.co.uk". Used to tell first-party requests from
+# third-party ones. IP addresses are returned unchanged. TLDs missing from
+# tlds.txt, which is older than most of the generic ones, are treated like
+# any other TLD, so "www.example.app" gives "example.app".
+def registrableDomain(host):
+    host = host.lower().rstrip(".")
+    labels = host.split(".")
+    if len(labels) < 2 or labels[-1].isdigit() or ":" in host:
+        return host
+    if len(labels[-1]) == 2 and len(labels) > 2 and labels[-2] in second_level_domains:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
 # Qt version.
 qt_version = qVersion()
 
@@ -142,6 +160,14 @@ def createUserAgent():
 try: app_locale = str(locale.getlocale()[0])
 except: app_locale = str(QLocale.system().name())
 
+# Emits settingChanged(key, value) whenever a setting changes, so that
+# code can react to the change instead of reading the setting over and over.
+class SettingsNotifier(QObject):
+    settingChanged = Signal(str, object)
+
+settings_notifier = SettingsNotifier()
+settings.settings.addListener(settings_notifier.settingChanged.emit)
+
 # WIDGET RELATED #
 
 # This is a global store for the settings dialog.
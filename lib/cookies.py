@@ -0,0 +1,325 @@
+#! /usr/bin/env python3
+
+# ----------
+# cookies.py
+# ----------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: A cookie jar that files cookies under the site they belong
+#              to, so that looking up the cookies for a request only looks
+#              at that site's cookies instead of every cookie stored.
+#              Cookies are kept in an SQLite database. Changes are written
+#              in batches shortly after they happen, and a site's cookies
+#              are only read from it when the site is first visited.
+
+import time
+import sqlite3
+import collections
+import common
+if not common.pyqt4:
+    from PyQt5.QtCore import QTimer, QByteArray
+    from PyQt5.QtNetwork import QNetworkCookieJar, QNetworkCookie
+else:
+    try:
+        from PyQt4.QtCore import QTimer, QByteArray
+        from PyQt4.QtNetwork import QNetworkCookieJar, QNetworkCookie
+    except:
+        from PySide.QtCore import QTimer, QByteArray
+        from PySide.QtNetwork import QNetworkCookieJar, QNetworkCookie
+
+# Most cookies kept for one site. The ones set longest ago go first.
+max_cookies_per_domain = 180
+
+# How long changes wait before they are written, in milliseconds.
+cookie_flush_delay = 2000
+
+# Returns the (name, domain, path) that tells a cookie apart from others.
+def cookieKey(cookie):
+    return (bytes(cookie.name().data()), cookie.domain().lower(), cookie.path())
+
+# Returns when a cookie expires in seconds since the epoch,
+# or None for session cookies.
+def cookieExpiry(cookie):
+    if cookie.isSessionCookie():
+        return None
+    try: return cookie.expirationDate().toMSecsSinceEpoch() / 1000.0
+    except: return cookie.expirationDate().toTime_t()
+
+# The site a cookie domain or host is filed under.
+def siteKey(domain):
+    return common.registrableDomain(domain.lstrip("."))
+
+# Checks whether a cookie's domain covers host. Domain cookies are stored
+# with a leading dot, and host-only cookies without one.
+def domainMatches(domain, host):
+    if domain.startswith("."):
+        return host == domain[1:] or host.endswith(domain)
+    return host == domain
+
+def pathMatches(path, urlPath):
+    if not path or path == "/" or urlPath == path:
+        return True
+    if not urlPath.startswith(path):
+        return False
+    return path.endswith("/") or urlPath[len(path)] == "/"
+
+def parseCookie(raw):
+    try: return QNetworkCookie.parseCookies(QByteArray(raw.encode("utf-8")))[0]
+    except: return None
+
+def rawCookie(cookie):
+    return cookie.toRawForm().data().decode("utf-8")
+
+# SQLite table of cookies, one row per cookie, looked up by site.
+class CookieStore(object):
+    def __init__(self, fname):
+        super(CookieStore, self).__init__()
+        self.fname = fname
+        self.connection = sqlite3.connect(fname)
+        try: self.connection.execute("PRAGMA journal_mode=WAL")
+        except: pass
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cookies (name BLOB, domain TEXT, path TEXT, site TEXT, raw TEXT, expiry REAL, PRIMARY KEY (name, domain, path))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cookies_site ON cookies (site)")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM cookies").fetchone()[0]
+
+    # Returns the raw forms of one site's cookies that haven't expired,
+    # oldest first, and deletes the ones that have.
+    def load(self, site, now=None):
+        now = time.time() if now == None else now
+        rows = self.connection.execute("SELECT raw FROM cookies WHERE site = ? AND (expiry IS NULL OR expiry > ?) ORDER BY rowid", (site, now)).fetchall()
+        self.connection.execute("DELETE FROM cookies WHERE site = ? AND expiry <= ?", (site, now))
+        self.connection.commit()
+        return [row[0] for row in rows]
+
+    def loadAll(self, now=None):
+        now = time.time() if now == None else now
+        return [row[0] for row in self.connection.execute("SELECT raw FROM cookies WHERE expiry IS NULL OR expiry > ? ORDER BY rowid", (now,))]
+
+    # Writes a batch of changes in one transaction. changes maps
+    # (name, domain, path) to a cookie, or to None to delete it.
+    # If reset is True, every stored cookie is dropped first.
+    def write(self, changes, reset=False):
+        with self.connection:
+            if reset:
+                self.connection.execute("DELETE FROM cookies")
+            deleted = [key for key, cookie in changes.items() if cookie == None]
+            stored = [key + (siteKey(key[1]), rawCookie(cookie), cookieExpiry(cookie)) for key, cookie in changes.items() if cookie != None]
+            self.connection.executemany("DELETE FROM cookies WHERE name = ? AND domain = ? AND path = ?", deleted)
+            self.connection.executemany("INSERT OR REPLACE INTO cookies (name, domain, path, site, raw, expiry) VALUES (?, ?, ?, ?, ?, ?)", stored)
+
+    def close(self):
+        try: self.connection.close()
+        except: pass
+
+class CookieJar(QNetworkCookieJar):
+    def __init__(self, parent=None):
+        super(CookieJar, self).__init__(parent)
+        # Site -> OrderedDict of cookieKey -> (cookie, expiry).
+        self.sites = {}
+        # cookieKey -> cookie, or None if it was deleted, since the last
+        # call to takeChanges.
+        self.changes = {}
+        # Set when every cookie has been replaced at once.
+        self.reset = False
+        # CookieStore that the cookies are kept in, if any, and the sites
+        # that have been read from it so far.
+        self.cookieStore = None
+        self.loadedSites = set()
+        self.loadedAll = True
+        self.flushTimer = QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flush)
+
+    # Keeps cookies in store from now on. Cookies already in the jar are
+    # dropped; the ones in store are read as their sites come up.
+    def setStore(self, store):
+        self.cookieStore = store
+        self.sites = {}
+        self.changes = {}
+        self.reset = False
+        self.loadedSites = set()
+        self.loadedAll = store == None
+
+    # Reads a site's cookies from the store, if that hasn't been done yet.
+    def loadSite(self, site):
+        if self.loadedAll or site in self.loadedSites:
+            return
+        self.loadedSites.add(site)
+        cookies = self.sites.setdefault(site, collections.OrderedDict())
+        for raw in self.cookieStore.load(site):
+            cookie = parseCookie(raw)
+            if cookie != None:
+                cookies[cookieKey(cookie)] = (cookie, cookieExpiry(cookie))
+
+    def loadAll(self):
+        if self.loadedAll:
+            return
+        for raw in self.cookieStore.loadAll():
+            cookie = parseCookie(raw)
+            if cookie == None:
+                continue
+            key = cookieKey(cookie)
+            site = siteKey(key[1])
+            if site in self.loadedSites:
+                continue
+            self.sites.setdefault(site, collections.OrderedDict())[key] = (cookie, cookieExpiry(cookie))
+        self.loadedAll = True
+
+    # Records a change and arranges for it to be written.
+    def changed(self, key, cookie):
+        self.changes[key] = cookie
+        if self.cookieStore != None and not self.flushTimer.isActive():
+            self.flushTimer.start(cookie_flush_delay)
+
+    # Writes pending changes to the store.
+    def flush(self):
+        self.flushTimer.stop()
+        if self.cookieStore == None or not self.isDirty():
+            return
+        reset, changes = self.takeChanges()
+        try: self.cookieStore.write(changes, reset)
+        except:
+            # Try again with the next batch.
+            self.reset = self.reset or reset
+            changes.update(self.changes)
+            self.changes = changes
+
+    def __len__(self):
+        return sum(len(site) for site in self.sites.values())
+
+    def isDirty(self):
+        return self.reset or bool(self.changes)
+
+    # Returns (whether every cookie was replaced, changed cookies), and
+    # marks the jar as clean.
+    def takeChanges(self):
+        reset, changes = self.reset, self.changes
+        self.reset = False
+        self.changes = {}
+        return reset, changes
+
+    def allCookies(self):
+        self.loadAll()
+        now = time.time()
+        return [cookie for site in self.sites.values() for cookie, expiry in site.values() if expiry == None or expiry > now]
+
+    # Adds cookies without touching the ones already stored, as when
+    # moving cookies saved by older versions into the store.
+    def importCookies(self, cookies):
+        for cookie in cookies:
+            self.store(cookie)
+
+    def setAllCookies(self, cookies):
+        self.sites = {}
+        self.changes = {}
+        self.reset = True
+        self.loadedAll = True
+        for cookie in cookies:
+            self.store(cookie)
+        if self.cookieStore != None:
+            self.flushTimer.start(cookie_flush_delay)
+
+    # Files a cookie away without checking it. Returns False if it had
+    # already expired.
+    def store(self, cookie):
+        expiry = cookieExpiry(cookie)
+        key = cookieKey(cookie)
+        self.loadSite(siteKey(key[1]))
+        site = self.sites.setdefault(siteKey(key[1]), collections.OrderedDict())
+        if key in site:
+            del site[key]
+        if expiry != None and expiry <= time.time():
+            self.changed(key, None)
+            return False
+        site[key] = (cookie, expiry)
+        self.changed(key, cookie)
+        while len(site) > max_cookies_per_domain:
+            self.changed(site.popitem(last=False)[0], None)
+        return True
+
+    def remove(self, cookie):
+        key = cookieKey(cookie)
+        self.loadSite(siteKey(key[1]))
+        site = self.sites.get(siteKey(key[1]))
+        if not site or not key in site:
+            return False
+        del site[key]
+        self.changed(key, None)
+        return True
+
+    # Checks whether url may set cookie. It may only set cookies for its
+    # own host or the parent domains of it, and not for a public suffix
+    # such as co.uk or github.io. Qt 5 checks the latter against its
+    # public suffix list; Qt 4 doesn't have validateCookie, so the public
+    # suffix is taken from QUrl.topLevelDomain() there.
+    def validateCookie(self, cookie, url):
+        try:
+            if not QNetworkCookieJar.validateCookie(self, cookie, url):
+                return False
+        except AttributeError:
+            pass
+        host = url.host().lower()
+        domain = cookie.domain().lower()
+        if not domain:
+            return True
+        if not domainMatches(domain if domain.startswith(".") else "." + domain, host):
+            return False
+        try: suffix = url.topLevelDomain().lower().lstrip(".")
+        except: suffix = siteKey(host).partition(".")[2]
+        return len(domain.lstrip(".")) > len(suffix)
+
+    def insertCookie(self, cookie):
+        return self.store(cookie)
+
+    def updateCookie(self, cookie):
+        return self.store(cookie)
+
+    def deleteCookie(self, cookie):
+        return self.remove(cookie)
+
+    def setCookiesFromUrl(self, cookies, url):
+        added = False
+        for cookie in cookies:
+            try: cookie.normalize(url)
+            except:
+                if not cookie.domain():
+                    cookie.setDomain(url.host())
+                if not cookie.path():
+                    cookie.setPath(url.path().rpartition("/")[0] or "/")
+            if not self.validateCookie(cookie, url):
+                continue
+            if self.store(cookie):
+                added = True
+        return added
+
+    # Cookies that expired are dropped here, when their site is next
+    # looked at, instead of by going through the whole jar.
+    def cookiesForUrl(self, url):
+        host = url.host().lower()
+        self.loadSite(siteKey(host))
+        site = self.sites.get(siteKey(host))
+        if not site:
+            return []
+        now = time.time()
+        secure = url.scheme() == "https"
+        urlPath = url.path() or "/"
+        cookies = []
+        expired = []
+        for key, (cookie, expiry) in site.items():
+            if expiry != None and expiry <= now:
+                expired.append(key)
+            elif domainMatches(key[1], host) and pathMatches(key[2], urlPath) and (secure or not cookie.isSecure()):
+                cookies.append(cookie)
+        for key in expired:
+            del site[key]
+            self.changed(key, None)
+        # Cookies with longer paths go first.
+        cookies.sort(key=lambda cookie: -len(cookie.path()))
+        return cookies
+
+    def clear(self):
+        self.setAllCookies([])
@@ -8,7 +8,10 @@
 # Description: This module contains data related to browser history, cookies,
 #              etc.
 
+import os
 import common
+import cookies
+import history_store
 import network
 import traceback
 import json
@@ -24,11 +27,18 @@ else:
         from PySide.QtCore import QCoreApplication, QByteArray, QUrl
         from PySide.QtNetwork import QNetworkCookie
 
-# Global list to store history.
-history = {}
-
 data = QSettings("nimbus", "data", portable=common.portable)
 
+# Cookies and history are kept in their own databases next to data.json.
+cookies_file = os.path.join(data.fulldirname, "cookies.sqlite")
+history_file = os.path.join(data.fulldirname, "history.sqlite")
+
+# Global store for browser history.
+history = history_store.HistoryStore(history_file)
+
+# User agents picked for particular sites, by authority.
+user_agents = {}
+
 # These store the geolocation whitelist and blacklist.
 geolocation_whitelist = []
 geolocation_blacklist = []
@@ -55,41 +65,64 @@ def shortUrl(url):
     return i
 
 def setUserAgentForUrl(user_agent, url):
-    global history
     if type(url) is QUrl:
         url = url.authority()
-    try: history[url]
-    except: history[url] = {}
-    history[url]["user_agent"] = str(user_agent)
+    user_agents[url] = str(user_agent)
 
 def userAgentForUrl(url):
     if type(url) is QUrl:
         url = url.authority()
-    try: return history[url]["user_agent"]
+    try: return user_agents[url]
     except: return None
 
 # This function loads the browser's settings.
 def loadData():
-    # Load history.
-    global history
+    global user_agents
     global geolocation_whitelist
     global geolocation_blacklist
+
+    try: ua = json.loads(str(data.value("data/UserAgents")))
+    except: pass
+    else:
+        if type(ua) is dict:
+            user_agents = ua
+
+    # Move history saved by older versions into the database. Those kept
+    # per-site user agents alongside it.
     raw_history = data.value("data/History")
     if type(raw_history) is str:
-        history = json.loads(raw_history)
-        if type(history) is list:
-            new_history = {}
-            for item in history:
-                new_history[item] = {"title": item, "last_visited": 0}
-            history = new_history
-
-    # Load cookies.
+        try: old_history = json.loads(raw_history)
+        except: old_history = {}
+        if type(old_history) is list:
+            old_history = dict((item, {"title": item, "last_visited": 0}) for item in old_history)
+        items = []
+        for url, item in old_history.items():
+            if "user_agent" in item:
+                user_agents[url] = item["user_agent"]
+            if "title" in item or "last_visited" in item:
+                items.append((url, item.get("title"), item.get("last_visited", 0), 1))
+        try: history.importItems(items)
+        except: traceback.print_exc()
+        else:
+            data.remove("data/History")
+            data.flush()
+
+    # Open the cookie database. Cookies are read from it per site, as
+    # they're needed.
+    try: network.cookie_jar.setStore(cookies.CookieStore(cookies_file))
+    except: traceback.print_exc()
+
+    # Move cookies saved by older versions into the database. They're only
+    # added, so that running this again can't wipe newer cookies, and the
+    # old key is dropped from data.json straight away.
     try: raw_cookies = json.loads(str(data.value("data/Cookies")))
     except: pass
     else:
         if type(raw_cookies) is list:
-            cookies = [QNetworkCookie().parseCookies(QByteArray(cookie))[0] for cookie in raw_cookies]
-            network.cookie_jar.setAllCookies(cookies)
+            network.cookie_jar.importCookies([QNetworkCookie().parseCookies(QByteArray(cookie.encode("utf-8")))[0] for cookie in raw_cookies])
+            network.cookie_jar.flush()
+        data.remove("data/Cookies")
+        data.flush()
 
     try: wl = json.loads(str(data.value("data/GeolocationWhitelist")))
     except: pass
@@ -105,16 +138,13 @@ def loadData():
 
 # This function saves the browser's settings.
 def saveData():
-    # Save history.
-    global history
-    for item in history:
-        try: del history[item]["short"]
-        except: pass
-    data.setValue("data/History", json.dumps(history))
+    # Write any visits that are still waiting.
+    try: history.flush()
+    except: traceback.print_exc()
+    data.setValue("data/UserAgents", json.dumps(user_agents))
 
-    # Save cookies.
-    cookies = json.dumps([cookie.toRawForm().data().decode("utf-8") for cookie in network.cookie_jar.allCookies()])
-    data.setValue("data/Cookies", cookies)
+    # Write any cookie changes that are still waiting.
+    network.cookie_jar.flush()
 
     data.setValue("data/GeolocationWhitelist", json.dumps(geolocation_whitelist))
     data.setValue("data/GeolocationBlacklist", json.dumps(geolocation_blacklist))
@@ -124,8 +154,7 @@ def saveData():
 
 # Clear history.
 def clearHistory():
-    global history
-    history = {}
+    history.clear()
     saveData()
 
 # Clear cookies.
@@ -2,9 +2,8 @@ history = data.history
 mainWindow = browser.activeWindow()
 mainWindow.addTab()
 links = ""
-sorted_history = sorted(history.items(), key=lambda x: (x[1]["last_visited"] if "last_visited" in x[1].keys() else 0), reverse=True)
-for item in sorted_history:
-    links += "\n        <a href='%s'>%s</a> (%s)<br>" % (QUrl.fromUserInput(item[0]).toString(),item[1]["title"],QDateTime.fromMSecsSinceEpoch(item[1]["last_visited"] if "last_visited" in item[1].keys() else 0).toString())
+for item in history.recent(1000):
+    links += "\n        <a href='%s'>%s</a> (%s, %s)<br>" % (QUrl.fromUserInput(item.url).toString(),item.title,QDateTime.fromMSecsSinceEpoch(item.last_visited or 0).toString(),tr("%d visits") % (item.visits,) if item.visits != 1 else tr("1 visit"))
 html = """<!DOCTYPE html>
 <html>
     <head>
@@ -8,7 +8,15 @@
 # Description: Loads URL filtering rules to be used by network.py.
 
 import os.path
+import base64
+import collections
+import hashlib
+import json
+import marshal
+import mmap
 import abpy
+import host_filter
+import subscriptions
 import common
 import settings
 if not common.pyqt4:
@@ -21,57 +29,145 @@ else:
 class Filter(object):
     def __init__(self, rules):
         super(Filter, self).__init__()
-        self.index = {}
-    def match(self, url):
+    def __len__(self):
+        return 0
+    def match(self, url, elementtype=None, host=None, first_party=None, third_party=None):
         return None
 
 # Global stuff.
 adblock_folder = os.path.join(settings.settings_folder, "adblock")
 easylist = os.path.join(common.app_folder, "easylist.txt")
 adblock_css = os.path.join(common.app_folder, "adblock.css")
+adblock_snapshot = os.path.join(settings.settings_folder, "adblock.bin")
 adblock_filter = Filter([])
 shelved_filter = None
-adblock_rules = []
+cosmetic_filter = abpy.CosmeticFilter([])
+
+# Lists every file that adblock rules are read from.
+def adblock_sources():
+    sources = []
+    if os.path.exists(easylist):
+        sources.append(easylist)
+    if os.path.exists(adblock_folder):
+        for fname in sorted(os.listdir(adblock_folder)):
+            if not fname.endswith(".tmp"):
+                sources.append(os.path.join(adblock_folder, fname))
+    return sources
+
+def file_hash(fname):
+    try: f = open(fname, "rb")
+    except: return None
+    try: return hashlib.sha1(f.read()).hexdigest()
+    except: return None
+    finally: f.close()
+
+# Describes the rule sources as [path, mtime, size, sha1] entries.
+# The hash is only computed when the cheaper stat data doesn't match.
+def source_stamps(sources, old_stamps=()):
+    old_stamps = {stamp[0]: stamp for stamp in old_stamps}
+    stamps = []
+    for fname in sources:
+        try: st = os.stat(fname)
+        except: continue
+        old = old_stamps.get(fname)
+        if old and old[1] == st.st_mtime and old[2] == st.st_size:
+            stamps.append(old)
+        else:
+            stamps.append([fname, st.st_mtime, st.st_size, file_hash(fname)])
+    return stamps
+
+def stamps_match(stamps, old_stamps):
+    return [(s[0], s[2], s[3]) for s in stamps] == [(s[0], s[2], s[3]) for s in old_stamps]
+
+# Loads a previously built abpy.Filter from adblock_snapshot, provided
+# it was built from the same rule files.
+def load_adblock_snapshot(sources):
+    if not os.path.isfile(adblock_snapshot):
+        return None
+    try: f = open(adblock_snapshot, "rb")
+    except: return None
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try: snapshot = marshal.loads(mm)
+        finally: mm.close()
+    except:
+        return None
+    finally:
+        f.close()
+    try:
+        stamps = source_stamps(sources, snapshot["sources"])
+        if not stamps_match(stamps, snapshot["sources"]):
+            return None
+    except:
+        return None
+    new_filter = abpy.Filter.from_snapshot(snapshot)
+    new_cosmetic_filter = abpy.CosmeticFilter.from_snapshot(snapshot.get("cosmetic"))
+    if new_filter and new_cosmetic_filter:
+        return new_filter, new_cosmetic_filter
+    return None
+
+def save_adblock_snapshot(adblock_filter, cosmetic_filter, sources):
+    snapshot = adblock_filter.snapshot()
+    snapshot["cosmetic"] = cosmetic_filter.snapshot()
+    snapshot["sources"] = source_stamps(sources)
+    tmp = adblock_snapshot + ".tmp"
+    try: f = open(tmp, "wb")
+    except: return
+    try: marshal.dump(snapshot, f)
+    except:
+        f.close()
+        return
+    f.close()
+    try: os.replace(tmp, adblock_snapshot)
+    except: pass
 
 # Load adblock rules.
 def load_adblock_rules():
     global adblock_filter
-    global adblock_rules
     global shelved_filter
+    global cosmetic_filter
 
-    if len(adblock_rules) < 1:
-        # Load easylist.
-        if os.path.exists(easylist):
-            f = open(easylist)
-            try: adblock_rules += [rule.rstrip("\n") for rule in f.readlines()]
-            except: pass
-            f.close()
-        # Load additional filters.
-        if os.path.exists(adblock_folder):
-           for fname in os.listdir(adblock_folder):
-               f = open(os.path.join(adblock_folder, fname))
-               try: adblock_rules += [rule.rstrip("\n") for rule in f.readlines()]
-               except: pass
-               f.close()
-
-    # Create instance of abpy.Filter.
     if shelved_filter:
         adblock_filter = shelved_filter
-    else:
-        adblock_filter = abpy.Filter(adblock_rules)
+        return
+
+    # Use the snapshot left behind by an earlier build if the rule
+    # files haven't changed since.
+    sources = adblock_sources()
+    snapshot_filters = load_adblock_snapshot(sources)
+    if snapshot_filters:
+        adblock_filter, cosmetic_filter = snapshot_filters
         shelved_filter = adblock_filter
+        return
+
+    # The raw lines aren't kept around once the filter is built.
+    adblock_rules = []
+    for fname in sources:
+        f = open(fname)
+        try: adblock_rules += [rule.rstrip("\n") for rule in f.readlines()]
+        except: pass
+        f.close()
+
+    # Create instances of abpy.Filter and abpy.CosmeticFilter.
+    new_cosmetic_filter = abpy.CosmeticFilter(adblock_rules)
+    adblock_filter = abpy.Filter(adblock_rules)
+    cosmetic_filter = new_cosmetic_filter
+    shelved_filter = adblock_filter
+    save_adblock_snapshot(adblock_filter, cosmetic_filter, sources)
 
 # Thread to load Adblock filters.
 class AdblockFilterLoader(QThread):
     def __init__(self, parent=None):
         super(AdblockFilterLoader, self).__init__(parent)
     def run(self):
+        global adblock_filter
+        global shelved_filter
         if settings.setting_to_bool("content/AdblockEnabled"):
             load_adblock_rules()
+            if settings.setting_to_bool("content/AdblockProfilingEnabled"):
+                adblock_filter.enable_profiling()
         else:
-            global adblock_filter
-            global shelved_filter
-            if len(adblock_filter.index.keys()) > 0:
+            if len(adblock_filter) > 0:
                 shelved_filter = adblock_filter
             adblock_filter = abpy.Filter([])
         self.quit()
@@ -79,21 +175,227 @@ class AdblockFilterLoader(QThread):
 # Create thread to load adblock filters.
 adblock_filter_loader = AdblockFilterLoader()
 
+# Filter list subscriptions.
+# Lists named in content/AdblockSubscriptions are downloaded into the
+# adblock folder and checked again once they expire. Changes are worked
+# into a copy of the live filter on a worker thread, which then replaces
+# it in one assignment, so requests are never left unfiltered.
+subscription_manager = subscriptions.SubscriptionManager(os.path.join(settings.settings_folder, "subscriptions.json"), adblock_folder)
+
+# Applies a number of (old rules, new rules) changes to the loaded filters.
+def apply_rule_changes(changes):
+    global adblock_filter
+    global shelved_filter
+    global cosmetic_filter
+
+    # Nothing has been loaded yet, so the next load will read the new files.
+    base = shelved_filter
+    if not base:
+        return
+    sources = adblock_sources()
+    lines = []
+    for fname in sources:
+        lines += subscriptions.read_lines(fname)
+    current = set(lines)
+    added = []
+    removed = []
+    for old_lines, new_lines in changes:
+        a, r = subscriptions.diff_rules(old_lines, new_lines)
+        added += a
+        removed += r
+    # Rules dropped from one list may still be in another.
+    removed = [rule for rule in removed if rule not in current]
+    new_filter = base.updated(added, removed)
+    if base.profile is not None:
+        new_filter.enable_profiling()
+    new_cosmetic_filter = abpy.CosmeticFilter(lines)
+    shelved_filter = new_filter
+    if adblock_filter is base:
+        adblock_filter = new_filter
+    cosmetic_filter = new_cosmetic_filter
+    save_adblock_snapshot(new_filter, new_cosmetic_filter, sources)
+
+def update_subscriptions():
+    changes = subscription_manager.sync(settings.setting_to_list("content/AdblockSubscriptions"))
+    for subscription in subscription_manager.due():
+        try: change = subscription_manager.update(subscription)
+        except: continue
+        if change:
+            changes.append(change)
+    subscription_manager.save()
+    if changes:
+        apply_rule_changes(changes)
+
+# Thread to update subscriptions.
+class SubscriptionUpdater(QThread):
+    def __init__(self, parent=None):
+        super(SubscriptionUpdater, self).__init__(parent)
+    def run(self):
+        adblock_filter_loader.wait()
+        update_subscriptions()
+        self.quit()
+
+subscription_updater = SubscriptionUpdater()
+
+# Adblock profiling.
+# With content/AdblockProfilingEnabled set, the filter counts how often
+# each rule is looked at and hit, and how long its regex takes. The
+# results are shown at nimbus://adblock-stats, which also links to the raw
+# data as JSON and to a copy of the rules without the ones that never hit
+# or are too slow.
+adblock_stats_url = "nimbus://adblock-stats"
+adblock_stats_json_url = adblock_stats_url + "/stats.json"
+pruned_rules_url = adblock_stats_url + "/pruned.txt"
+
+def adblock_stats():
+    try: return adblock_filter.profile_stats()
+    except: return None
+
+def adblock_stats_json():
+    return json.dumps(adblock_stats())
+
+# Returns the text of a rule file holding the blocking and exception rules
+# that were hit during profiling and aren't slow, followed by every element
+# hiding rule from the sources, since those aren't profiled.
+def pruned_adblock_rules(min_hits=1, max_time=0.0001):
+    try: rules = adblock_filter.pruned_rules(min_hits, max_time)
+    except: rules = None
+    if rules == None:
+        return ""
+    lines = ["[Adblock Plus 2.0]", "! Pruned by Nimbus from %s requests" % (adblock_filter.profile.requests,)] + rules
+    for fname in adblock_sources():
+        try: f = open(fname)
+        except: continue
+        try: lines += [line.rstrip("\n") for line in f if "##" in line or "#@#" in line]
+        except: pass
+        f.close()
+    return "\n".join(lines) + "\n"
+
+def escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def adblock_stats_page(limit=50):
+    stats = adblock_stats()
+    if not stats:
+        body = "<p>Adblock profiling is off. Set <code>content/AdblockProfilingEnabled</code> to <code>true</code> and restart Nimbus to turn it on.</p>"
+    else:
+        rules = stats["rules"]
+        never_hit = len([rule for rule in rules if not rule["hits"]])
+        total_time = sum(rule["time"] for rule in rules)
+        def table(title, rows):
+            return "<h2>%s</h2><table><tr><th>Rule</th><th>Candidates</th><th>Hits</th><th>Regex time (ms)</th></tr>%s</table>" % (title, "".join(["<tr><td><code>%s</code></td><td>%s</td><td>%s</td><td>%.3f</td></tr>" % (escape_html(rule["rule"]), rule["candidates"], rule["hits"], rule["time"] * 1000) for rule in rows]))
+        body = "<p>%(requests)s requests checked over %(seconds)d seconds, spending %(time).1f ms in rule regexes. %(never_hit)s of %(count)s rules were never hit.</p>" % {"requests": stats["requests"], "seconds": stats["seconds"], "time": total_time * 1000, "never_hit": never_hit, "count": len(rules)}
+        body += "<p><a href=\"%s\">Raw data (JSON)</a> &middot; <a href=\"%s\">Pruned rule file</a></p>" % (adblock_stats_json_url, pruned_rules_url)
+        body += table("Slowest rules", sorted(rules, key=lambda rule: rule["time"], reverse=True)[:limit])
+        body += table("Most hit rules", sorted(rules, key=lambda rule: rule["hits"], reverse=True)[:limit])
+        body += table("Most looked at rules", sorted(rules, key=lambda rule: rule["candidates"], reverse=True)[:limit])
+    return "<!DOCTYPE html><html><head><title>Adblock statistics</title><style type='text/css'>html{font-family:sans-serif;}td,th{text-align:left;padding-right:1em;}</style></head><body><h1>Adblock statistics</h1>%s</body></html>" % (body,)
+
+# Element hiding.
+# Pages get a single user stylesheet that holds user.css, the generic
+# element hiding rules and Ad Remover selectors, and the rules specific to
+# the page's host. Each part is base64-encoded on its own, padded to a
+# multiple of three bytes so that the encoded parts can simply be joined.
+# That way the large shared part is encoded once, and only the small
+# host-specific parts are cached per host. Hosts whose exceptions remove
+# some generic rules need a whole stylesheet of their own, so only a few
+# of those are kept.
+hiding_css_cache = {"key": None, "shared": "", "hosts": collections.OrderedDict(), "custom": collections.OrderedDict()}
+hiding_css_cache_sizes = {"hosts": 256, "custom": 8}
+
+def hiding_css(selectors):
+    return "".join([selector + " { display: none !important; }\n" for selector in selectors])
+
+def css_chunk(css):
+    css = css.encode("utf-8")
+    css += b" " * (-len(css) % 3)
+    return base64.b64encode(css).decode("utf-8")
+
+def read_user_css():
+    try: f = open(settings.user_css, "r")
+    except: return ""
+    try: return f.read() + "\n"
+    except: return ""
+    finally: f.close()
+
+def cache_hiding_css(name, host, chunk):
+    entries = hiding_css_cache[name]
+    entries[host] = chunk
+    if len(entries) > hiding_css_cache_sizes[name]:
+        entries.popitem(last=False)
+
+# Returns a data: URL of the user stylesheet for pages on host, or None
+# if no elements need to be hidden.
+def user_stylesheet_url(host):
+    adblock = settings.setting_to_bool("content/AdblockEnabled")
+    adremover = adblock or settings.setting_to_bool("content/HostFilterEnabled")
+    if not adremover:
+        return None
+    try: user_css_mtime = os.path.getmtime(settings.user_css)
+    except: user_css_mtime = None
+    key = (cosmetic_filter, tuple(settings.adremover_filters), adblock, user_css_mtime)
+    cache = hiding_css_cache
+    if cache["key"] != key:
+        cache["key"] = key
+        cache["user"] = read_user_css()
+        cache["adremover"] = hiding_css(settings.adremover_filters)
+        cache["shared"] = css_chunk(cache["user"] + (hiding_css(cosmetic_filter.generic) if adblock else "") + cache["adremover"])
+        cache["hosts"].clear()
+        cache["custom"].clear()
+    prefix = "data:text/css;charset=utf-8;base64,"
+    if host in cache["hosts"]:
+        cache["hosts"].move_to_end(host)
+        return prefix + cache["shared"] + cache["hosts"][host]
+    if host in cache["custom"]:
+        cache["custom"].move_to_end(host)
+        return prefix + cache["custom"][host]
+    if not adblock:
+        cache_hiding_css("hosts", host, "")
+        return prefix + cache["shared"]
+    generic, specific = cosmetic_filter.selectors(host)
+    if generic is cosmetic_filter.generic:
+        chunk = css_chunk(hiding_css(specific))
+        cache_hiding_css("hosts", host, chunk)
+        return prefix + cache["shared"] + chunk
+    chunk = css_chunk(cache["user"] + hiding_css(generic) + cache["adremover"] + hiding_css(specific))
+    cache_hiding_css("custom", host, chunk)
+    return prefix + chunk
+
 # Host filter.
+# The bundled hosts file and any files in ~/.nimbus/hosts are compiled
+# into one sorted domain file, which is only rebuilt when they change.
 hosts_file = os.path.join(common.app_folder, "hosts")
-host_rules = []
+hosts_folder = os.path.join(settings.settings_folder, "hosts")
+compiled_hosts = os.path.join(settings.settings_folder, "hosts.bin")
+host_rules = host_filter.HostFilter()
+
+# Lists every hosts file that domains are read from.
+def host_sources():
+    sources = []
+    if os.path.exists(hosts_file):
+        sources.append(hosts_file)
+    if os.path.isdir(hosts_folder):
+        for fname in sorted(os.listdir(hosts_folder)):
+            sources.append(os.path.join(hosts_folder, fname))
+    return sources
 
 def load_host_rules():
     global host_rules
-    if os.path.exists(hosts_file):
-        try: f = open(hosts_file, "r")
-        except: pass
-        else:
-            # This is a big hacky way of parsing the rules.
-            try:
-                host_rules = [line for line in [line.split(" ")[1].replace("\n", "") for line in f.readlines() if len(line.split(" ")) > 1 and not line.startswith("#") and len(line) > 1] if line != ""]
-            except:
-                pass
-            f.close()
+    sources = host_sources()
+    new_rules = host_filter.HostFilter()
+    try:
+        new_rules.open(compiled_hosts)
+        old_stamps = new_rules.header["sources"]
+        if not stamps_match(source_stamps(sources, old_stamps), old_stamps):
+            new_rules.close()
+    except:
+        new_rules.close()
+    if not new_rules.header or not len(new_rules):
+        try:
+            host_filter.compile_domains(host_filter.read_hosts_files(sources), compiled_hosts, {"sources": source_stamps(sources)})
+            new_rules.open(compiled_hosts)
+        except:
+            new_rules.close()
+    host_rules = new_rules
 
 load_host_rules()
@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+
+# ----------------
+# history_store.py
+# ----------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: Browsing history, kept in an SQLite database. Visits are
+#              held back and written in batches, and the history is read
+#              with queries (most recent, by host, by time range) instead
+#              of being loaded into memory whole.
+
+import time
+import sqlite3
+try: from urllib.parse import urlsplit
+except ImportError: from urlparse import urlsplit
+
+# Number of pending visits that makes add() write them straight away.
+max_pending = 100
+
+def hostOf(url):
+    try: return (urlsplit(url).hostname or "").lower()
+    except: return ""
+
+# Milliseconds since the epoch, which is what last_visited is stored in.
+def now():
+    return int(time.time() * 1000)
+
+class HistoryItem(object):
+    def __init__(self, url, title, last_visited, visits):
+        super(HistoryItem, self).__init__()
+        self.url = url
+        self.title = title
+        self.last_visited = last_visited
+        self.visits = visits
+
+class HistoryStore(object):
+    def __init__(self, fname):
+        super(HistoryStore, self).__init__()
+        self.fname = fname
+        # url -> [title, last visited, visit count] for visits that haven't
+        # been written yet. A visit count of 0 means only the title changed.
+        self.pending = {}
+        self.connection = sqlite3.connect(fname)
+        try: self.connection.execute("PRAGMA journal_mode=WAL")
+        except: pass
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS history (url TEXT PRIMARY KEY, host TEXT, title TEXT, last_visited INTEGER, visits INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_host ON history (host)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_last_visited ON history (last_visited)")
+        self.connection.commit()
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def __contains__(self, url):
+        if url in self.pending and self.pending[url][2]:
+            return True
+        return self.connection.execute("SELECT 1 FROM history WHERE url = ?", (url,)).fetchone() != None
+
+    # Records a visit to url.
+    def add(self, url, title=None, last_visited=None):
+        last_visited = now() if last_visited == None else last_visited
+        visit = self.pending.get(url)
+        if visit:
+            visit[0] = title if title != None else visit[0]
+            visit[1] = max(visit[1] or 0, last_visited)
+            visit[2] += 1
+        else:
+            self.pending[url] = [title, last_visited, 1]
+        if len(self.pending) >= max_pending:
+            self.flush()
+
+    # Changes the title of a page that is already in the history.
+    def setTitle(self, url, title):
+        visit = self.pending.get(url)
+        if visit:
+            visit[0] = title
+        else:
+            self.pending[url] = [title, None, 0]
+
+    # Writes pending visits in one transaction.
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with self.connection:
+            for url, (title, last_visited, visits) in pending.items():
+                if not visits:
+                    self.connection.execute("UPDATE history SET title = ? WHERE url = ?", (title, url))
+                    continue
+                cursor = self.connection.execute("UPDATE history SET title = COALESCE(?, title), last_visited = MAX(COALESCE(last_visited, 0), ?), visits = visits + ? WHERE url = ?", (title, last_visited, visits, url))
+                if cursor.rowcount == 0:
+                    self.connection.execute("INSERT INTO history (url, host, title, last_visited, visits) VALUES (?, ?, ?, ?, ?)", (url, hostOf(url), title, last_visited, visits))
+
+    # Adds many (url, title, last visited, visits) rows at once, as when
+    # importing history saved by older versions.
+    def importItems(self, items):
+        self.flush()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO history (url, host, title, last_visited, visits) VALUES (?, ?, ?, ?, ?)", [(url, hostOf(url), title, last_visited, visits) for url, title, last_visited, visits in items])
+
+    def query(self, where="", args=(), limit=None):
+        self.flush()
+        sql = "SELECT url, title, last_visited, visits FROM history %s ORDER BY last_visited DESC" % (where,)
+        if limit != None:
+            sql += " LIMIT %d" % (int(limit),)
+        return [HistoryItem(*row) for row in self.connection.execute(sql, args)]
+
+    # The most recently visited pages.
+    def recent(self, limit=100):
+        return self.query(limit=limit)
+
+    def byHost(self, host, limit=None):
+        return self.query("WHERE host = ?", (host.lower(),), limit)
+
+    # Pages last visited between start and end, in milliseconds since
+    # the epoch.
+    def between(self, start, end, limit=None):
+        return self.query("WHERE last_visited >= ? AND last_visited < ?", (start, end), limit)
+
+    def urls(self, limit=None):
+        return [item.url for item in self.query(limit=limit)]
+
+    # Read-only dict-style access, for extensions written when the history
+    # was a dict of url -> {"title": ..., "last_visited": ...}.
+    def itemDict(self, item):
+        return {"title": item.title, "last_visited": item.last_visited or 0, "visits": item.visits}
+
+    def __getitem__(self, url):
+        items = self.query("WHERE url = ?", (url,))
+        if not items:
+            raise KeyError(url)
+        return self.itemDict(items[0])
+
+    def get(self, url, default=None):
+        try: return self[url]
+        except KeyError: return default
+
+    def keys(self):
+        return self.urls()
+
+    def __iter__(self):
+        return iter(self.urls())
+
+    def items(self):
+        return [(item.url, self.itemDict(item)) for item in self.query()]
+
+    def values(self):
+        return [self.itemDict(item) for item in self.query()]
+
+    def remove(self, url):
+        self.pending.pop(url, None)
+        with self.connection:
+            self.connection.execute("DELETE FROM history WHERE url = ?", (url,))
+
+    def clear(self):
+        self.pending = {}
+        with self.connection:
+            self.connection.execute("DELETE FROM history")
+
+    def close(self):
+        self.flush()
+        try: self.connection.close()
+        except: pass
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+
+# --------------
+# host_filter.py
+# --------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: A host blocklist that stays small no matter how many domains
+#              it holds. Hosts files are compiled into a sorted domain file,
+#              which is memory-mapped and binary-searched, so lookups don't
+#              need the domains to be loaded into Python objects.
+
+import os
+import json
+import mmap
+import struct
+import bisect
+
+# File layout:
+#   magic, version, header length, domain count      (HEADER_FORMAT)
+#   JSON header (whatever the caller wants to store alongside the domains)
+#   padding up to a multiple of four bytes
+#   count + 1 offsets into the domain blob           (native uint32)
+#   domain blob, sorted, each domain encoded in ASCII
+MAGIC = b"NHST"
+VERSION = 1
+HEADER_FORMAT = "<4sIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Names that show up in hosts files but aren't meant as blocks.
+ignored_names = ("localhost", "localhost.localdomain", "local", "broadcasthost", "ip6-localhost", "ip6-loopback")
+
+# Returns the domains listed on one line of a hosts file.
+# Both "127.0.0.1 example.com" and bare "example.com" lines are understood.
+def parse_hosts_line(line):
+    line = line.split("#", 1)[0].strip().lower()
+    if not line:
+        return []
+    fields = line.split()
+    if len(fields) > 1:
+        fields = fields[1:]
+    return [name.rstrip(".") for name in fields if "." in name and name not in ignored_names]
+
+# Reads every domain listed in a number of hosts files.
+def read_hosts_files(fnames):
+    domains = set()
+    for fname in fnames:
+        try: f = open(fname, "r", errors="replace")
+        except: continue
+        try:
+            for line in f:
+                domains.update(parse_hosts_line(line))
+        except: pass
+        f.close()
+    return domains
+
+# Writes a compiled domain file that HostFilter can open.
+def compile_domains(domains, fname, header=None):
+    domains = sorted(set(domain.encode("ascii", "ignore") for domain in domains))
+    header = json.dumps(header if header != None else {}).encode("utf-8")
+    header += b" " * (-(HEADER_SIZE + len(header)) % 4)
+    offsets = [0]
+    for domain in domains:
+        offsets.append(offsets[-1] + len(domain))
+    tmp = fname + ".tmp"
+    f = open(tmp, "wb")
+    try:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(header), len(domains)))
+        f.write(header)
+        f.write(struct.pack("=%dI" % (len(offsets),), *offsets))
+        f.write(b"".join(domains))
+    finally:
+        f.close()
+    os.replace(tmp, fname)
+
+# Sequence view of the sorted domains in a compiled file,
+# so that bisect can search it without copying anything.
+class _DomainList(object):
+    def __init__(self, data, base, offsets):
+        self.data = data
+        self.base = base
+        self.offsets = offsets
+    def __len__(self):
+        return len(self.offsets) - 1
+    def __getitem__(self, i):
+        return self.data[self.base + self.offsets[i]:self.base + self.offsets[i+1]]
+
+class HostFilter(object):
+    def __init__(self, fname=None):
+        super(HostFilter, self).__init__()
+        self.header = {}
+        self._file = None
+        self._mmap = None
+        self._domains = ()
+        if fname:
+            self.open(fname)
+
+    # Maps a compiled domain file. Raises ValueError if it isn't one.
+    def open(self, fname):
+        self.close()
+        f = open(fname, "rb")
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+        try:
+            magic, version, header_len, count = struct.unpack_from(HEADER_FORMAT, mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a compiled host list" % (fname,))
+            header = json.loads(mm[HEADER_SIZE:HEADER_SIZE + header_len].decode("utf-8"))
+            start = HEADER_SIZE + header_len
+            end = start + 4 * (count + 1)
+            offsets = memoryview(mm)[start:end].cast("I")
+        except:
+            mm.close()
+            f.close()
+            raise
+        self.header = header
+        self._file = f
+        self._mmap = mm
+        self._domains = _DomainList(mm, end, offsets)
+
+    def close(self):
+        self.header = {}
+        if self._mmap:
+            self._domains.offsets.release()
+            self._domains = ()
+            self._mmap.close()
+            self._mmap = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._domains)
+
+    def __contains__(self, domain):
+        domain = domain.encode("ascii", "ignore")
+        domains = self._domains
+        i = bisect.bisect_left(domains, domain)
+        return i < len(domains) and domains[i] == domain
+
+    # Returns the listed domain that blocks host, or None.
+    # host may carry a port, and all of its parent domains are checked too.
+    def match(self, host):
+        if not self._domains or not host:
+            return None
+        host = host.lower()
+        if host.startswith("["):
+            return None
+        host = host.rsplit(":", 1)[0] if ":" in host else host
+        host = host.rstrip(".")
+        while "." in host:
+            if host in self:
+                return host
+            host = host.partition(".")[2]
+        return None
@@ -63,6 +63,9 @@ else:
         from PySide.QtNetwork import QNetworkRequest
         from PySide.QtWebKit import QWebPage
 
+# Number of history items offered by the location bar.
+location_bar_history = 1000
+
 # Extension button class.
 class ExtensionButton(QToolButton):
     def __init__(self, name=None, script="", etype="python", shortcut=None, aboutText=None, parent=None):
@@ -341,13 +344,9 @@ class MainWindow(QMainWindow):
         # implementation that looks nicer.
         self.locationBar = custom_widgets.LocationBar(icon=None, parent=self)
 
-        # Load stored browser history.
-        if type(data.history) is list:
-            for url in data.history:
-                self.locationBar.addItem(url)
-        else:
-            for url in data.history.keys():
-                self.locationBar.addItem(data.shortUrl(url))
+        # Load the most recently visited pages from the browser history.
+        for url in data.history.urls(location_bar_history):
+            self.locationBar.addItem(data.shortUrl(url))
 
         # Combo boxes are not normally editable by default.
         self.locationBar.setEditable(True)
@@ -734,10 +733,7 @@ class MainWindow(QMainWindow):
             self.locationBar.setFocus()
             self.locationBar.lineEdit().selectAll()
         else:
-            if type(data.history) is list:
-                items = [url for url in data.history if len(url) < 65]
-            else:
-                items = [data.shortUrl(url) for url in data.history.keys() if len(data.shortUrl(url)) < 65]
+            items = [data.shortUrl(url) for url in data.history.urls(location_bar_history) if len(data.shortUrl(url)) < 65]
             try: common.feeds
             except: pass
             else:
@@ -889,7 +885,7 @@ class MainWindow(QMainWindow):
                  webView.windowCreated.connect(self.addTab)
             if style:
                 self.sideBars[name]["sideBar"].\
-                     webView.settings().setUserStyleSheetUrl(QUrl.fromUserInput(str(style)))    
+                     webView.page().setCustomStyleSheet(QUrl.fromUserInput(str(style)))
             self.sideBars[name]["sideBar"].\
                  webView.setUserAgent(ua)
             self.sideBars[name]["sideBar"].\
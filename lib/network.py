@@ -12,54 +12,114 @@
 
 import sys
 import os
+import time
+import mmap
+import mimetypes
+import threading
+import heapq
+import collections
+import email.utils
+try:
+    import queue
+    from urllib.parse import quote
+except ImportError:
+    import Queue as queue
+    from urllib import quote
 import common
+import cookies
 import settings
 import filtering
 import settings
 from translate import tr
 if not common.pyqt4:
-    from PyQt5.QtCore import QCoreApplication, QUrl, QTimer
+    from PyQt5.QtCore import QCoreApplication, QObject, QUrl, QTimer, QBuffer, QIODevice, pyqtSignal
+    Signal = pyqtSignal
     from PyQt5.QtWidgets import QInputDialog, QLineEdit
-    from PyQt5.QtNetwork import QNetworkInterface, QNetworkCookieJar, QNetworkAccessManager, QNetworkDiskCache, QNetworkRequest, QNetworkReply
+    from PyQt5.QtNetwork import QNetworkInterface, QNetworkConfigurationManager, QNetworkAccessManager, QAbstractNetworkCache, QNetworkDiskCache, QNetworkCacheMetaData, QNetworkRequest, QNetworkReply
 else:
     try:
-        from PyQt4.QtCore import QCoreApplication, QUrl, QTimer, SIGNAL
+        from PyQt4.QtCore import QCoreApplication, QObject, QUrl, QTimer, QBuffer, QIODevice, SIGNAL, pyqtSignal
+        Signal = pyqtSignal
         from PyQt4.QtGui import QInputDialog, QLineEdit
-        from PyQt4.QtNetwork import QNetworkInterface, QNetworkCookieJar, QNetworkAccessManager, QNetworkDiskCache, QNetworkRequest, QNetworkReply
+        from PyQt4.QtNetwork import QNetworkInterface, QNetworkConfigurationManager, QNetworkAccessManager, QAbstractNetworkCache, QNetworkDiskCache, QNetworkCacheMetaData, QNetworkRequest, QNetworkReply
     except:
-        from PySide.QtCore import QCoreApplication, QUrl, QTimer, SIGNAL
+        from PySide.QtCore import QCoreApplication, QObject, QUrl, QTimer, QBuffer, QIODevice, SIGNAL, Signal
         from PySide.QtGui import QInputDialog, QLineEdit
-        from PySide.QtNetwork import QNetworkInterface, QNetworkCookieJar, QNetworkAccessManager, QNetworkDiskCache, QNetworkRequest, QNetworkReply
+        from PySide.QtNetwork import QNetworkInterface, QNetworkConfigurationManager, QNetworkAccessManager, QAbstractNetworkCache, QNetworkDiskCache, QNetworkCacheMetaData, QNetworkRequest, QNetworkReply
 
 # Global cookiejar to store cookies.
 # All nimbus.WebView instances use this.
-cookie_jar = QNetworkCookieJar(QCoreApplication.instance())
+cookie_jar = cookies.CookieJar(QCoreApplication.instance())
 
 # All incognito nimbus.WebView instances use this one instead.
-incognito_cookie_jar = QNetworkCookieJar(QCoreApplication.instance())
+incognito_cookie_jar = cookies.CookieJar(QCoreApplication.instance())
 
-# Subclass of QNetworkReply that loads a local folder.
+# How long NetworkReply waits for a chunk that isn't ready, in milliseconds.
+chunk_poll_interval = 10
+
+# Subclass of QNetworkReply that serves content generated by Nimbus, such as
+# folder listings and internal pages.
+# content can be a str, which is encoded once, or bytes, a bytearray or a
+# memoryview, which are served as they are. It can also be an iterable of
+# such chunks, which are pulled one at a time from the event loop, so that
+# large bodies never have to be put together in one piece. An iterable can
+# yield an empty chunk to say that it is still waiting for data.
 class NetworkReply(QNetworkReply):
-    def __init__(self, parent, url, operation, content=""):
+    def __init__(self, parent, url, operation, content="", ctype="text/html; charset=UTF-8"):
         QNetworkReply.__init__(self, parent)
-        self.content = content
+        self.chunks = None
         self.offset = 0
-        self.setHeader(QNetworkRequest.ContentTypeHeader, "text/html; charset=UTF-8")
-        self.setHeader(QNetworkRequest.ContentLengthHeader, len(self.content))
-        try:
-            QTimer.singleShot(0, self.readyRead)
-            QTimer.singleShot(0, self.finished)
-        except:
-            QTimer.singleShot(0, self, SIGNAL("readyRead()"))
-            QTimer.singleShot(0, self, SIGNAL("finished()"))
+        if isinstance(content, (str, bytes, bytearray, memoryview)):
+            self.content = self.chunkView(content)
+        else:
+            self.content = memoryview(b"")
+            self.chunks = iter(content)
+        self.setHeader(QNetworkRequest.ContentTypeHeader, ctype)
+        if self.chunks == None:
+            self.setHeader(QNetworkRequest.ContentLengthHeader, len(self.content))
         self.open(self.ReadOnly | self.Unbuffered)
         self.setUrl(url)
+        if self.chunks == None:
+            try:
+                QTimer.singleShot(0, self.readyRead)
+                QTimer.singleShot(0, self.finished)
+            except:
+                QTimer.singleShot(0, self, SIGNAL("readyRead()"))
+                QTimer.singleShot(0, self, SIGNAL("finished()"))
+        else:
+            QTimer.singleShot(0, self.nextChunk)
+
+    def chunkView(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        return memoryview(chunk).cast("B")
+
+    # Moves on to the next chunk once the current one has been read.
+    def nextChunk(self):
+        if self.chunks == None:
+            return
+        if self.offset < len(self.content):
+            QTimer.singleShot(0, self.nextChunk)
+            return
+        try: chunk = next(self.chunks)
+        except StopIteration:
+            self.chunks = None
+            self.finished.emit()
+            return
+        self.content = self.chunkView(chunk)
+        self.offset = 0
+        if len(self.content):
+            self.readyRead.emit()
+            QTimer.singleShot(0, self.nextChunk)
+        else:
+            # An empty chunk means the rest isn't ready yet.
+            QTimer.singleShot(chunk_poll_interval, self.nextChunk)
 
     def abort(self):
-        pass
+        self.chunks = None
 
     def bytesAvailable(self):
-        return len(self.content) - self.offset
+        return len(self.content) - self.offset + QNetworkReply.bytesAvailable(self)
     
     def isSequential(self):
         return True
@@ -68,35 +128,949 @@ class NetworkReply(QNetworkReply):
         if self.offset < len(self.content):
             end = min(self.offset + maxSize, len(self.content))
             data = self.content[self.offset:end]
-            data = data.encode("utf-8")
             self.offset = end
-            return bytes(data)
+            return data.tobytes()
+        if self.chunks != None:
+            return b""
 
 # Error page generator.
 def errorPage(title="Problem loading page", heading="Whoops...", error="Nimbus could not load the requested page.", suggestions=["Try reloading the page.", "Make sure you're connected to the Internet. Once you're connected, try loading this page again.", "Check for misspellings in the URL (e.g. <b>ww.google.com</b> instead of <b>www.google.com</b>).", "The server may be experiencing some downtime. Wait for a while before trying again.", "If your computer or network is protected by a firewall, make sure that Nimbus is permitted ."]):
     return "<!DOCTYPE html><html><title>%(title)s</title><style type='text/css'>html{font-family:sans-serif;}</style><body><h1>%(heading)s</h1><p>%(error)s</p><ul>%(suggestions)s</ul></body></html>" % {"title": tr(title), "heading": tr(heading), "error": tr(error), "suggestions": "".join(["<li>" + tr(suggestion) + "</li>" for suggestion in suggestions])}
 
+# Reads a query parameter of a local URL.
+def queryValue(urlString, name, default=None):
+    query = urlString.partition("?")[2].partition("#")[0]
+    for item in query.split("&"):
+        key, sep, value = item.partition("=")
+        if key == name:
+            return value
+    return default
+
+def queryInt(urlString, name, default=0):
+    try: return max(0, int(queryValue(urlString, name, default)))
+    except: return default
+
+# Folder listings are read by a worker thread and shown in pages.
+directory_page_size = 1000
+directory_row_batch = 200
+directory_sort_keys = ("name", "size", "mtime")
+
+# The last few folders that were read, so that paging through one or
+# sorting it again doesn't read it again.
+directory_cache = collections.OrderedDict()
+directory_cache_size = 4
+# Listings are read by worker threads, so directory_cache is only touched
+# while this is held.
+directory_cache_lock = threading.Lock()
+
 directoryView = """<!DOCTYPE html>
 <html>
     <head>
         <title>%(title)s</title>
+        <style type="text/css">td, th { padding: 0 1em 0 0; text-align: left; } td.size { text-align: right; }</style>
     </head>
     <body>
         <h1 style="margin-bottom: 0;">%(heading)s</h1>
         <hr/>
-        %(links)s
+        <table>
+            <tr><th>%(name)s</th><th>%(size)s</th><th>%(mtime)s</th></tr>
+            %(rows)s
+        </table>
+        <hr/>
+        %(navigation)s
     </body>
 </html>
 """
 
+def formatSize(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % (size,)
+
+# Returns (name, is folder, size, modification time) for everything in a
+# folder. os.scandir gets the file type without a stat call on most
+# systems; os.listdir is used where it isn't available.
+def scanDirectory(path):
+    entries = []
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            try:
+                isdir = entry.is_dir()
+                stat = entry.stat()
+                entries.append((entry.name, isdir, 0 if isdir else stat.st_size, stat.st_mtime))
+            except OSError:
+                entries.append((entry.name, False, 0, 0))
+    else:
+        for name in os.listdir(path):
+            fname = os.path.join(path, name)
+            try:
+                isdir = os.path.isdir(fname)
+                stat = os.stat(fname)
+                entries.append((name, isdir, 0 if isdir else stat.st_size, stat.st_mtime))
+            except OSError:
+                entries.append((name, False, 0, 0))
+    return entries
+
+# Reads a folder, or takes it from directory_cache if it hasn't changed.
+def directoryEntries(path):
+    try: mtime = os.stat(path).st_mtime
+    except OSError: mtime = None
+    with directory_cache_lock:
+        cached = directory_cache.get(path)
+        if cached and cached[0] == mtime:
+            directory_cache.move_to_end(path)
+            return cached[1]
+    entries = scanDirectory(path)
+    with directory_cache_lock:
+        directory_cache[path] = (mtime, entries)
+        directory_cache.move_to_end(path)
+        while len(directory_cache) > directory_cache_size:
+            directory_cache.popitem(last=False)
+    return entries
+
+# Runs in a worker thread. Sorts a folder and puts rows of HTML for one
+# page of it in results, followed by the number of entries.
+def listDirectory(path, base, sort, reverse, page, results):
+    try:
+        entries = directoryEntries(path)
+        if sort == "name":
+            key = lambda entry: entry[0].lower()
+        elif sort == "size":
+            key = lambda entry: entry[2]
+        else:
+            key = lambda entry: entry[3]
+        # Folders always come first.
+        entries = sorted(entries, key=lambda entry: (not entry[1] if not reverse else entry[1], key(entry)), reverse=reverse)
+        start = page * directory_page_size
+        rows = []
+        if page == 0:
+            rows.append("<tr><td><a href=\"%s\">..</a></td><td></td><td></td></tr>" % (base + "..",))
+        for name, isdir, size, mtime in entries[start:start + directory_page_size]:
+            rows.append("<tr><td><a href=\"%s\">%s</a></td><td class=\"size\">%s</td><td>%s</td></tr>" % (base + quote(name) + ("/" if isdir else ""), filtering.escape_html(name) + ("/" if isdir else ""), "" if isdir else formatSize(size), time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))))
+            if len(rows) >= directory_row_batch:
+                results.put("".join(rows))
+                rows = []
+        if rows:
+            results.put("".join(rows))
+        results.put(len(entries))
+    except Exception as e:
+        results.put("<tr><td colspan=\"3\">%s</td></tr>" % (filtering.escape_html(str(e)),))
+        results.put(0)
+
+# Yields the folder listing for a file:// URL in chunks. The heading goes
+# out straight away, and the rows follow as the worker thread produces them.
+def directoryListing(url):
+    urlString = url.toString()
+    base = urlString.partition("?")[0].partition("#")[0]
+    if not base.endswith("/"):
+        base += "/"
+    path = os.path.abspath(url.path())
+    sort = queryValue(urlString, "sort", "name")
+    if not sort in directory_sort_keys:
+        sort = "name"
+    reverse = queryValue(urlString, "order") == "desc"
+    page = queryInt(urlString, "page")
+    def link(text, sort, reverse, page=0):
+        return "<a href=\"%s?sort=%s&amp;order=%s&amp;page=%d\">%s</a>" % (base, sort, "desc" if reverse else "asc", page, text)
+    headings = {}
+    for key, text in (("name", "Name"), ("size", "Size"), ("mtime", "Modified")):
+        headings[key] = link(text + ((" &#9660;" if reverse else " &#9650;") if key == sort else ""), key, key == sort and not reverse)
+    head, tail = directoryView.split("%(rows)s")
+    headings.update({"title": filtering.escape_html(urlString), "heading": filtering.escape_html(url.path())})
+    yield head % headings
+    results = queue.Queue()
+    worker = threading.Thread(target=listDirectory, args=(path, base, sort, reverse, page, results))
+    worker.daemon = True
+    worker.start()
+    while True:
+        try: chunk = results.get_nowait()
+        except queue.Empty:
+            yield ""
+            continue
+        if not isinstance(chunk, str):
+            break
+        yield chunk
+    pages = max(1, (chunk + directory_page_size - 1) // directory_page_size)
+    links = []
+    if page > 0:
+        links.append(link("Previous", sort, reverse, page - 1))
+    if page + 1 < pages:
+        links.append(link("Next", sort, reverse, page + 1))
+    yield tail % {"navigation": "<p>%d items, page %d of %d %s</p>" % (chunk, min(page + 1, pages), pages, " | ".join(links))}
+
+# Local text files at least this big are paged through a light viewer
+# instead of being handed to WebKit whole.
+large_file_size = 4 * 1024 * 1024
+file_page_size = 256 * 1024
+file_chunk_size = 32 * 1024
+text_extensions = (".txt", ".log", ".csv", ".tsv", ".json", ".xml", ".sql", ".md", ".ini", ".cfg", ".conf", ".out", ".err")
+
+fileView = """<!DOCTYPE html>
+<html>
+    <head>
+        <title>%(title)s</title>
+        <style type="text/css">pre { white-space: pre-wrap; word-wrap: break-word; }</style>
+    </head>
+    <body>
+        <h1 style="margin-bottom: 0;">%(heading)s</h1>
+        %(navigation)s
+        <hr/>
+        <pre>%(content)s</pre>
+        <hr/>
+        %(navigation)s
+    </body>
+</html>
+"""
+
+# Checks whether a local file should go through MappedFileReply.
+def isLargeTextFile(path):
+    try:
+        if not os.path.isfile(path) or os.path.getsize(path) < large_file_size:
+            return False
+    except:
+        return False
+    if path.lower().endswith(text_extensions):
+        return True
+    mimetype = mimetypes.guess_type(path)[0]
+    return mimetype != None and mimetype.startswith("text/")
+
+# Moves offset forward to the start of the next line, so that pages don't
+# begin or end halfway through a line (or a UTF-8 sequence). Very long lines
+# are cut anyway.
+def nextLineStart(mm, offset, limit=4096):
+    if offset <= 0 or offset >= len(mm) or mm[offset-1:offset] == b"\n":
+        return min(max(offset, 0), len(mm))
+    newline = mm.find(b"\n", offset, min(offset + limit, len(mm)))
+    return offset if newline == -1 else newline + 1
+
+# Subclass of NetworkReply that shows one page of a large local text file.
+# The file is memory-mapped, and only the part of it that is on the page
+# is read, so it takes the same amount of memory no matter how big the file
+# is. The offset query parameter picks the page.
+class MappedFileReply(NetworkReply):
+    def __init__(self, parent, url, path):
+        self.file = open(path, "rb")
+        try: self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+        urlString = url.toString()
+        self.base = urlString.partition("?")[0].partition("#")[0]
+        self.start = nextLineStart(self.mmap, queryInt(urlString, "offset"))
+        self.end = nextLineStart(self.mmap, self.start + file_page_size)
+        NetworkReply.__init__(self, parent, url, QNetworkAccessManager.GetOperation, self.page(path))
+
+    def link(self, offset, text):
+        return "<a href=\"%s?offset=%d\">%s</a>" % (self.base.replace("\"", "%22"), offset, text)
+
+    def navigation(self):
+        size = len(self.mmap)
+        links = []
+        if self.start > 0:
+            links.append(self.link(0, "First"))
+            links.append(self.link(max(0, self.start - file_page_size), "Previous"))
+        if self.end < size:
+            links.append(self.link(self.end, "Next"))
+            links.append(self.link(max(0, size - file_page_size), "Last"))
+        return "<p>Bytes %d&ndash;%d of %d %s</p>" % (self.start, self.end, size, " | ".join(links))
+
+    def page(self, path):
+        try:
+            navigation = self.navigation()
+            head, tail = fileView.split("%(content)s")
+            yield head % {"title": filtering.escape_html(self.base), "heading": filtering.escape_html(os.path.basename(path)), "navigation": navigation}
+            offset = self.start
+            while offset < self.end:
+                end = nextLineStart(self.mmap, min(offset + file_chunk_size, self.end))
+                end = min(max(end, offset + 1), self.end)
+                yield filtering.escape_html(self.mmap[offset:end].decode("utf-8", "replace"))
+                offset = end
+            yield tail % {"navigation": navigation}
+        finally:
+            self.unmap()
+
+    def unmap(self):
+        try: self.mmap.close()
+        except: pass
+        try: self.file.close()
+        except: pass
+
+    def abort(self):
+        NetworkReply.abort(self)
+        self.unmap()
+
 replacement_table = {"http://personalitycafe.com/images/styles/PersonalityCafe/misc/Other.gif": "http://personalitycafe.com/images/styles/PersonalityCafe/misc/Neutral.gif"}
 
+# Blank image that blocked requests are redirected to.
+blocked_url = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAACXBIWXMAAAsTAAALEwEAmpwYAAAAB3RJTUUH3QgdBBMTEi/JQgAAABl0RVh0Q29tbWVudABDcmVhdGVkIHdpdGggR0lNUFeBDhcAAAAMSURBVAjXY/j//z8ABf4C/tzMWecAAAAASUVORK5CYII="
+
+# Possible outcomes of NetworkAccessManager.decide.
+# Rewrites are stored as the URL to load instead.
+ALLOW = None
+BLOCK = True
+
+# Bounded least-recently-used store of createRequest's decisions, keyed on
+# (URL, request type, first-party host). It empties itself whenever the
+# adblock filter or host list it was filled from gets swapped out, and is
+# cleared when a setting it depends on changes.
+class DecisionCache(object):
+    def __init__(self, size=4096):
+        super(DecisionCache, self).__init__()
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.filters = None
+        self.hits = 0
+        self.misses = 0
+    def clear(self):
+        self.entries.clear()
+    def get(self, key):
+        filters = (filtering.adblock_filter, filtering.host_rules)
+        if filters != self.filters:
+            self.entries.clear()
+            self.filters = filters
+        try: decision = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return decision
+    def set(self, key, decision):
+        self.entries[key] = decision
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "size": self.size, "hits": self.hits, "misses": self.misses, "hit_rate": (float(self.hits) / lookups if lookups else 0.0)}
+
+decision_cache = DecisionCache()
+
+# Decisions depend on these settings, so they're forgotten when one changes.
+decision_settings = ("content/HostFilterEnabled", "content/FlashEnabled", "content/GIFsEnabled")
+
+def clearDecisionsOnChange(key, value):
+    if key in decision_settings:
+        decision_cache.clear()
+
+common.settings_notifier.settingChanged.connect(clearDecisionsOnChange)
+
+# Returns the host of the page that a request was made from.
+def firstPartyHost(request):
+    try: return request.originatingObject().page().mainFrame().url().host()
+    except: return ""
+
+# File extensions that give away what a request is for.
+request_types = {".js": "script", ".css": "stylesheet", ".swf": "object",
+                 ".png": "image", ".jpg": "image", ".jpeg": "image", ".gif": "image",
+                 ".bmp": "image", ".ico": "image", ".svg": "image", ".webp": "image"}
+
+# Works out the adblock element type of a request, such as "script" or "image".
+# QtWebKit doesn't say what a request is for, so this goes by the Accept
+# header WebKit sends, the frame the request comes from and the URL.
+def requestType(request, url):
+    try: accept = request.rawHeader(b"Accept").data().decode("latin-1")
+    except: accept = ""
+    if request.hasRawHeader(b"X-Requested-With"):
+        return "xmlhttprequest"
+    if accept.startswith("text/html") or accept.startswith("application/xhtml"):
+        try: frame = request.originatingObject()
+        except: frame = None
+        if frame != None and frame.parentFrame() != None:
+            return "subdocument"
+        return "document"
+    if accept.startswith("text/css"):
+        return "stylesheet"
+    if accept.startswith("image/"):
+        return "image"
+    return request_types.get(os.path.splitext(url.path())[1].lower(), "other")
+
+# Maximum cache size in bytes, from data/MaximumCacheSize (in MB).
+def maximumCacheSize():
+    return max(settings.setting_to_int("data/MaximumCacheSize"), 0) * 1024 * 1024
+
+# Counters shared by the caches below.
+class CacheStats(object):
+    def __init__(self):
+        super(CacheStats, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved, "hit_rate": (float(self.hits) / lookups if lookups else 0.0)}
+
+# HTTP disk cache.
+# QNetworkDiskCache throws out the entries that were written first when it
+# runs out of room. This one throws out the ones that were least recently
+# used instead, going by the time each URL was last served from the cache.
+class DiskCache(QNetworkDiskCache):
+    def __init__(self, folder, size, parent=None):
+        super(DiskCache, self).__init__(parent)
+        self.counters = CacheStats()
+        self.accessed = {}
+        self.fileUrls = {}
+        self.setCacheDirectory(folder)
+        self.setMaximumCacheSize(size)
+    def metaData(self, url):
+        metaData = QNetworkDiskCache.metaData(self, url)
+        if not metaData.isValid():
+            self.counters.misses += 1
+        return metaData
+    def data(self, url):
+        device = QNetworkDiskCache.data(self, url)
+        if device is not None:
+            self.counters.hits += 1
+            self.counters.bytes_saved += device.size()
+            self.accessed[url.toString()] = time.time()
+        return device
+    def remove(self, url):
+        self.accessed.pop(url.toString(), None)
+        return QNetworkDiskCache.remove(self, url)
+    def clear(self):
+        self.accessed.clear()
+        self.fileUrls.clear()
+        QNetworkDiskCache.clear(self)
+    def expire(self):
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.cacheDirectory()):
+            for fname in files:
+                if not fname.endswith(".d"):
+                    continue
+                path = os.path.join(root, fname)
+                try: st = os.stat(path)
+                except: continue
+                if not path in self.fileUrls:
+                    self.fileUrls[path] = self.fileMetaData(path).url().toString()
+                entries.append((max(st.st_mtime, self.accessed.get(self.fileUrls[path], 0)), st.st_size, path))
+                total += st.st_size
+        if total <= self.maximumCacheSize():
+            return total
+        # Like QNetworkDiskCache, leave some room so that this doesn't run
+        # again on the very next insert.
+        goal = self.maximumCacheSize() * 9 // 10
+        entries.sort()
+        for accessed, size, path in entries:
+            if total <= goal:
+                break
+            try: os.remove(path)
+            except: continue
+            total -= size
+            self.accessed.pop(self.fileUrls.pop(path, None), None)
+        return total
+    def stats(self):
+        stats = self.counters.stats()
+        stats.update({"size": self.cacheSize(), "maximum_size": self.maximumCacheSize()})
+        return stats
+
+# In-memory HTTP cache for incognito windows, so that nothing they load
+# ends up on disk. Entries are kept in least recently used order.
+class MemoryCache(QAbstractNetworkCache):
+    def __init__(self, size, parent=None):
+        super(MemoryCache, self).__init__(parent)
+        self.counters = CacheStats()
+        self.maximumSize = size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+    def setMaximumCacheSize(self, size):
+        self.maximumSize = size
+        self.expire()
+    def maximumCacheSize(self):
+        return self.maximumSize
+    def cacheSize(self):
+        return self.size
+    def metaData(self, url):
+        key = url.toString()
+        if key in self.entries:
+            return self.entries[key][0]
+        self.counters.misses += 1
+        return QNetworkCacheMetaData()
+    def updateMetaData(self, metaData):
+        key = metaData.url().toString()
+        if key in self.entries:
+            self.entries[key] = (metaData, self.entries[key][1])
+    def data(self, url):
+        key = url.toString()
+        if not key in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        content = self.entries[key][1]
+        self.counters.hits += 1
+        self.counters.bytes_saved += len(content)
+        device = QBuffer()
+        device.setData(content)
+        device.open(QIODevice.ReadOnly)
+        return device
+    def remove(self, url):
+        key = url.toString()
+        for device, metaData in list(self.pending.values()):
+            if metaData.url().toString() == key:
+                del self.pending[id(device)]
+        if not key in self.entries:
+            return False
+        self.size -= len(self.entries.pop(key)[1])
+        return True
+    def prepare(self, metaData):
+        if not metaData.isValid() or not metaData.url().isValid() or self.maximumSize <= 0:
+            return None
+        device = QBuffer()
+        device.open(QIODevice.ReadWrite)
+        self.pending[id(device)] = (device, metaData)
+        return device
+    def insert(self, device):
+        try: device, metaData = self.pending.pop(id(device))
+        except KeyError: return
+        content = bytes(device.data())
+        device.close()
+        if len(content) > self.maximumSize:
+            return
+        self.remove(metaData.url())
+        self.entries[metaData.url().toString()] = (metaData, content)
+        self.size += len(content)
+        self.expire()
+    def expire(self):
+        while self.size > self.maximumSize and self.entries:
+            self.size -= len(self.entries.popitem(last=False)[1][1])
+    def clear(self):
+        self.entries.clear()
+        self.pending.clear()
+        self.size = 0
+    def stats(self):
+        stats = self.counters.stats()
+        stats.update({"size": self.size, "maximum_size": self.maximumSize})
+        return stats
+
+# Hot resource cache.
+# Small resources that are still fresh are kept in memory in front of the
+# disk cache, so that assets used all over the place (scripts from CDNs,
+# fonts, sprites, favicons) don't have to be read back from disk for every
+# tab. Entries are filled with the bytes a download received as they came
+# in, which InflightTransfer keeps anyway, so nothing is read back from
+# disk. They are keyed on the URL plus the request headers named by the
+# response's Vary header.
+#
+# Entries start out on probation, and move to the protected segment when
+# they are used again. New entries push out other probationary ones first,
+# so a burst of one-off resources can't flush out the ones that keep
+# getting used.
+hot_cache_size = 16 * 1024 * 1024
+hot_cache_entry_size = 1024 * 1024
+
+class HotCacheEntry(object):
+    def __init__(self, content, headers, expires):
+        super(HotCacheEntry, self).__init__()
+        self.content = content
+        self.headers = headers
+        self.expires = expires
+    def header(self, name):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+class HotCache(object):
+    def __init__(self, size=hot_cache_size, entry_size=hot_cache_entry_size):
+        super(HotCache, self).__init__()
+        self.maximumSize = size
+        self.entrySize = entry_size
+        self.maximumProtectedSize = size * 4 // 5
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.size = 0
+        self.protectedSize = 0
+        # URL -> [Vary header names, number of entries]
+        self.urls = {}
+        self.counters = CacheStats()
+    def key(self, url, requestHeader):
+        return (url,) + tuple([requestHeader(name) for name in self.urls[url][0]])
+    def get(self, url, requestHeader, now=None):
+        if not url in self.urls:
+            self.counters.misses += 1
+            return None
+        key = self.key(url, requestHeader)
+        entry = self.protected.get(key) or self.probation.get(key)
+        if not entry:
+            self.counters.misses += 1
+            return None
+        if entry.expires <= (time.time() if now == None else now):
+            self.remove(key)
+            self.counters.misses += 1
+            return None
+        if key in self.protected:
+            self.protected.move_to_end(key)
+        else:
+            del self.probation[key]
+            self.protected[key] = entry
+            self.protectedSize += len(entry.content)
+            self.evict()
+        self.counters.hits += 1
+        self.counters.bytes_saved += len(entry.content)
+        return entry
+    def put(self, url, requestHeader, entry, vary=()):
+        if len(entry.content) > self.entrySize:
+            return
+        if url in self.urls and self.urls[url][0] != tuple(vary):
+            for key in [key for segment in (self.probation, self.protected) for key in segment if key[0] == url]:
+                self.remove(key)
+        self.urls.setdefault(url, [tuple(vary), 0])
+        key = self.key(url, requestHeader)
+        self.remove(key)
+        # remove() drops the URL along with its last entry.
+        self.urls.setdefault(url, [tuple(vary), 0])[1] += 1
+        self.probation[key] = entry
+        self.size += len(entry.content)
+        self.evict()
+    def remove(self, key):
+        if key in self.protected:
+            entry = self.protected.pop(key)
+            self.protectedSize -= len(entry.content)
+        elif key in self.probation:
+            entry = self.probation.pop(key)
+        else:
+            return
+        self.size -= len(entry.content)
+        self.urls[key[0]][1] -= 1
+        if not self.urls[key[0]][1]:
+            del self.urls[key[0]]
+    def evict(self):
+        while self.protectedSize > self.maximumProtectedSize:
+            key, entry = self.protected.popitem(last=False)
+            self.protectedSize -= len(entry.content)
+            self.probation[key] = entry
+        while self.size > self.maximumSize:
+            key = next(iter(self.probation if self.probation else self.protected))
+            self.remove(key)
+    def clear(self):
+        self.probation.clear()
+        self.protected.clear()
+        self.urls.clear()
+        self.size = 0
+        self.protectedSize = 0
+    def stats(self):
+        stats = self.counters.stats()
+        stats.update({"size": self.size, "maximum_size": self.maximumSize, "entries": len(self.probation) + len(self.protected), "protected": len(self.protected)})
+        return stats
+
+hot_cache = HotCache()
+
+# Reply for resources served from hot_cache.
+class HotCacheReply(NetworkReply):
+    def __init__(self, parent, url, entry):
+        NetworkReply.__init__(self, parent, url, QNetworkAccessManager.GetOperation, entry.content, entry.header(b"Content-Type") or b"application/octet-stream")
+        for name, value in entry.headers:
+            if name.lower() != b"content-length":
+                self.setRawHeader(name, value)
+        self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute, 200)
+        self.setAttribute(QNetworkRequest.SourceIsFromCacheAttribute, True)
+
+def headerBytes(value):
+    try: return bytes(value)
+    except: return bytes(value.data())
+
+# Splits a Cache-Control or Pragma header into its lowercased directives.
+def cacheDirectives(value):
+    return [directive.strip() for directive in (value or b"").lower().split(b",") if directive.strip()]
+
+# Returns whether a request asks for the server to be asked again instead
+# of being answered from memory, as QtWebKit's reloads do.
+def bypassesHotCache(request):
+    if request.attribute(QNetworkRequest.CacheLoadControlAttribute) == QNetworkRequest.AlwaysNetwork:
+        return True
+    directives = cacheDirectives(headerBytes(request.rawHeader(b"Cache-Control"))) + cacheDirectives(headerBytes(request.rawHeader(b"Pragma")))
+    return b"no-cache" in directives or b"no-store" in directives or b"max-age=0" in directives
+
+def parseHttpDate(value):
+    try: return float(email.utils.mktime_tz(email.utils.parsedate_tz(value.decode("latin-1"))))
+    except: return None
+
+# Returns until when a response may be reused without asking the server,
+# in seconds since the epoch, or None if it doesn't say.
+def freshUntil(entry):
+    date = parseHttpDate(entry.header(b"Date") or b"") or time.time()
+    for directive in cacheDirectives(entry.header(b"Cache-Control")):
+        name, sep, value = directive.partition(b"=")
+        if name == b"max-age":
+            try: age = int(entry.header(b"Age") or 0)
+            except ValueError: age = 0
+            try: return date - age + int(value.strip(b'"'))
+            except ValueError: return None
+    return parseHttpDate(entry.header(b"Expires") or b"")
+
+# Puts a finished reply's response into hot_cache, provided the response
+# is still fresh and may be reused without asking the server again.
+# content is what the reply received.
+def fillHotCache(reply, content):
+    try:
+        if reply.error() != QNetworkReply.NoError or reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) != 200:
+            return
+        headers = [(headerBytes(name), headerBytes(value)) for name, value in reply.rawHeaderPairs()]
+        entry = HotCacheEntry(content, headers, None)
+        directives = cacheDirectives(entry.header(b"Cache-Control"))
+        if b"no-cache" in directives or b"no-store" in directives or b"must-revalidate" in directives:
+            return
+        if b"no-cache" in cacheDirectives(entry.header(b"Pragma")):
+            return
+        vary = [name.strip() for name in (entry.header(b"Vary") or b"").split(b",") if name.strip()]
+        if b"*" in vary:
+            return
+        entry.expires = freshUntil(entry)
+        if entry.expires == None or entry.expires <= time.time():
+            return
+        request = reply.request()
+        hot_cache.put(request.url().toString(), lambda name: headerBytes(request.rawHeader(name)), entry, vary)
+    except:
+        pass
+
+# Coalescing of in-flight requests.
+# When several tabs ask for the same resource at once, as after a session
+# restore, only the first request goes out. Every request for it gets a
+# SharedReply, which is fed a copy of whatever the single real reply
+# receives, including what arrived before it was made.
+coalescable_types = ("script", "stylesheet", "image", "other")
+
+# Received data is kept for late joiners up to this size. Bigger transfers
+# stop accepting new replies.
+inflight_buffer_size = 2 * 1024 * 1024
+
+# Attributes copied from the real reply.
+shared_attributes = (QNetworkRequest.HttpStatusCodeAttribute, QNetworkRequest.HttpReasonPhraseAttribute, QNetworkRequest.RedirectionTargetAttribute, QNetworkRequest.SourceIsFromCacheAttribute, QNetworkRequest.ConnectionEncryptedAttribute)
+
+# Returns whether a request may share its download with another one.
+# Credentialed, uncacheable and ranged requests always get their own.
+def isCoalescable(request, elementType):
+    if not elementType in coalescable_types:
+        return False
+    if request.attribute(QNetworkRequest.CacheLoadControlAttribute) == QNetworkRequest.AlwaysNetwork:
+        return False
+    url = request.url()
+    if url.userName() or url.password() or not url.scheme() in ("http", "https"):
+        return False
+    for name in (b"Authorization", b"Range", b"If-None-Match", b"If-Modified-Since"):
+        if request.hasRawHeader(name):
+            return False
+    cacheControl = headerBytes(request.rawHeader(b"Cache-Control")).lower() + headerBytes(request.rawHeader(b"Pragma")).lower()
+    return not (b"no-cache" in cacheControl or b"no-store" in cacheControl)
+
+# Returns whether a response may be handed to requests that join its
+# download late. Private, uncacheable and cookie-setting ones may not.
+def isShareableResponse(reply):
+    if reply.hasRawHeader(b"Set-Cookie"):
+        return False
+    directives = cacheDirectives(headerBytes(reply.rawHeader(b"Cache-Control")))
+    return not (b"no-store" in directives or b"private" in directives)
+
+# Requests only share a download if they only differ by Referer.
+def inflightKey(request):
+    return (request.url().toString(),) + tuple(sorted([(headerBytes(name).lower(), headerBytes(request.rawHeader(name))) for name in request.rawHeaderList() if headerBytes(name).lower() != b"referer"]))
+
+class SharedReply(QNetworkReply):
+    def __init__(self, parent, request, transfer):
+        QNetworkReply.__init__(self, parent)
+        self.transfer = transfer
+        self.buffer = bytearray()
+        self.live = False
+        self.hasMetaData = False
+        self.ended = False
+        self.setRequest(request)
+        self.setOperation(QNetworkAccessManager.GetOperation)
+        self.setUrl(request.url())
+        self.open(self.ReadOnly | self.Unbuffered)
+    # Signals are held back until Qt has handed the reply over.
+    def start(self):
+        self.live = True
+        if self.hasMetaData:
+            self.metaDataChanged.emit()
+        if self.buffer:
+            self.readyRead.emit()
+        if self.ended:
+            self.finished.emit()
+    def copyMetaData(self, reply):
+        self.setUrl(reply.url())
+        for name, value in reply.rawHeaderPairs():
+            self.setRawHeader(name, value)
+        for attribute in shared_attributes:
+            value = reply.attribute(attribute)
+            if value != None:
+                self.setAttribute(attribute, value)
+        self.hasMetaData = True
+        if self.live:
+            self.metaDataChanged.emit()
+    def feed(self, data):
+        self.buffer += data
+        if self.live:
+            self.readyRead.emit()
+    def progress(self, received, total):
+        if self.live:
+            self.downloadProgress.emit(received, total)
+    def end(self, error, errorString):
+        if error != QNetworkReply.NoError:
+            self.setError(error, errorString)
+        self.ended = True
+        self.setFinished(True)
+        if self.live:
+            self.finished.emit()
+    def abort(self):
+        if self.ended:
+            return
+        self.transfer.detach(self)
+        self.end(QNetworkReply.OperationCanceledError, "Operation canceled")
+    def ignoreSslErrors(self, *args):
+        self.transfer.ignoreSslErrors(*args)
+    def bytesAvailable(self):
+        return len(self.buffer) + QNetworkReply.bytesAvailable(self)
+    def isSequential(self):
+        return True
+    def readData(self, maxSize):
+        if self.buffer:
+            data = bytes(self.buffer[:maxSize])
+            del self.buffer[:maxSize]
+            return data
+        if not self.ended:
+            return b""
+
+# A real reply and the SharedReplies it feeds.
+# The real reply may come later, when the request is queued. If hot is
+# True, the response goes into hot_cache once it has finished.
+class InflightTransfer(object):
+    def __init__(self, manager, key, reply=None, hot=False):
+        super(InflightTransfer, self).__init__()
+        self.manager = manager
+        self.key = key
+        self.hot = hot
+        self.reply = None
+        self.sslErrorsIgnored = None
+        self.replies = []
+        self.chunks = []
+        self.size = 0
+        self.hasMetaData = False
+        if reply != None:
+            self.start(reply)
+    def start(self, reply):
+        self.reply = reply
+        if self.sslErrorsIgnored != None:
+            reply.ignoreSslErrors(*self.sslErrorsIgnored)
+        reply.metaDataChanged.connect(self.copyMetaData)
+        reply.readyRead.connect(self.read)
+        reply.downloadProgress.connect(self.progress)
+        reply.finished.connect(self.finish)
+    def ignoreSslErrors(self, *args):
+        if self.reply != None:
+            self.reply.ignoreSslErrors(*args)
+        else:
+            self.sslErrorsIgnored = args
+    def attach(self, shared):
+        if self.hasMetaData:
+            shared.copyMetaData(self.reply)
+        for chunk in self.chunks:
+            shared.feed(chunk)
+        self.replies.append(shared)
+        QTimer.singleShot(0, shared.start)
+        return shared
+    def detach(self, shared):
+        try: self.replies.remove(shared)
+        except ValueError: return
+        if not self.replies:
+            self.close()
+            if self.reply != None:
+                self.reply.abort()
+            else:
+                self.manager.dequeue(self)
+    # Stop taking new replies.
+    def close(self):
+        if self.manager.inflight.get(self.key) is self:
+            del self.manager.inflight[self.key]
+        self.chunks = None
+    def copyMetaData(self):
+        self.hasMetaData = True
+        if not isShareableResponse(self.reply):
+            self.close()
+        for shared in list(self.replies):
+            shared.copyMetaData(self.reply)
+    def read(self):
+        data = headerBytes(self.reply.readAll())
+        if self.chunks != None:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size > inflight_buffer_size:
+                self.close()
+        for shared in list(self.replies):
+            shared.feed(data)
+    def progress(self, received, total):
+        for shared in list(self.replies):
+            shared.progress(received, total)
+    def finish(self):
+        content = b"".join(self.chunks) if self.hot and self.chunks != None and self.size <= hot_cache.entrySize else None
+        self.close()
+        if content != None:
+            fillHotCache(self.reply, content)
+        for shared in list(self.replies):
+            shared.end(self.reply.error(), self.reply.errorString())
+        self.replies = []
+        self.reply.deleteLater()
+
+# Request scheduling.
+# GET requests are started right away while there are free slots, both
+# overall and for their host. The rest wait in a queue and are handed a
+# SharedReply that is hooked up to the real reply once a slot frees up.
+# Pages themselves are never held back.
+max_requests = 24
+max_requests_per_host = 6
+
+# Lower goes first.
+request_priorities = {"document": 0, "subdocument": 1, "stylesheet": 1, "script": 1, "image": 2, "xmlhttprequest": 2}
+default_priority = 3
+
+# Returns the page a request was made for, or None.
+def requestPage(request):
+    try: return request.originatingObject().page()
+    except: return None
+
+# Returns whether a page is in a tab that can't be seen.
+def isBackgroundPage(page):
+    try: return not page.view().isVisible()
+    except: return False
+
+class QueuedRequest(object):
+    def __init__(self, request, host, page, transfer):
+        super(QueuedRequest, self).__init__()
+        self.request = request
+        self.host = host
+        self.page = page
+        self.transfer = transfer
+        self.queued = time.time()
+
 # Custom NetworkAccessManager class with support for ad-blocking.
 class NetworkAccessManager(QNetworkAccessManager):
-    #diskCache = diskCache
     def __init__(self, *args, nocache=False, **kwargs):
         super(NetworkAccessManager, self).__init__(*args, **kwargs)
         self.authenticationRequired.connect(self.provideAuthentication)
+        # Incognito managers only cache in memory.
+        if nocache:
+            self.httpCache = MemoryCache(maximumCacheSize(), self)
+        else:
+            self.httpCache = DiskCache(settings.network_cache_folder, maximumCacheSize(), self)
+        self.setCache(self.httpCache)
+        self.inflight = {}
+        self.coalesced = 0
+        self.uncoalesced = 0
+        # Host -> page -> heap of (priority, sequence, QueuedRequest).
+        # Which tab is visible is checked when a slot frees up, once per
+        # page rather than once per request, so switching tabs takes
+        # effect for requests that are already waiting.
+        self.queues = {}
+        self.queueLength = 0
+        self.sequence = 0
+        self.active = 0
+        self.activePerHost = {}
+        self.scheduled = 0
+        self.queuedCount = 0
+        self.maxQueueDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
     def provideAuthentication(self, reply, auth):
         username = QInputDialog.getText(None, "Authentication", "Enter your username:", QLineEdit.Normal)
         if username[1]:
@@ -104,24 +1078,153 @@ class NetworkAccessManager(QNetworkAccessManager):
             password = QInputDialog.getText(None, "Authentication", "Enter your password:", QLineEdit.Password)
             if password[1]:
                 auth.setPassword(password[0])
-    def createRequest(self, op, request, device=None):
-        url = request.url()
-        ctype = str(request.header(QNetworkRequest.ContentTypeHeader))
-        urlString = url.toString()
+    # Works out whether to allow, block or rewrite a request.
+    def decide(self, url, urlString, ctype, elementType, firstParty):
+        if urlString in replacement_table:
+            return replacement_table[urlString]
         lurlString = urlString.lower()
-        x = filtering.adblock_filter.match(urlString)
-        y = url.authority() in filtering.host_rules if settings.setting_to_bool("content/HostFilterEnabled") and url.authority() != "" else False
+        host = url.host()
+        thirdParty = common.registrableDomain(host) != common.registrableDomain(firstParty) if firstParty else None
+        x = filtering.adblock_filter.match(urlString, elementType, host=host, first_party=firstParty or None, third_party=thirdParty)
+        y = filtering.host_rules.match(host) != None if settings.setting_to_bool("content/HostFilterEnabled") else False
         z = (lurlString.endswith(".swf") or "flash" in ctype) and not settings.setting_to_bool("content/FlashEnabled")
         aa = (lurlString.endswith(".gif") or "image/gif" in ctype) and not settings.setting_to_bool("content/GIFsEnabled")
-        if urlString in tuple(replacement_table.keys()):
-            return QNetworkAccessManager.createRequest(self, op, QNetworkRequest(QUrl(replacement_table[urlString])), device)
-        if url.scheme() == "file" and os.path.isdir(os.path.abspath(url.path())):
-            html = directoryView % {"title": urlString, "heading": url.path(), "links": "".join(["<a href=\"%s\">%s</a><br/>" % (QUrl.fromUserInput(os.path.join(urlString, path)).toString(), path,) for path in [".."] + sorted(os.listdir(os.path.abspath(url.path())))])}
-            return NetworkReply(self, url, self.GetOperation, html)
         if x != None or y or z or aa:
-            return QNetworkAccessManager.createRequest(self, self.GetOperation, QNetworkRequest(QUrl("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAACXBIWXMAAAsTAAALEwEAmpwYAAAAB3RJTUUH3QgdBBMTEi/JQgAAABl0RVh0Q29tbWVudABDcmVhdGVkIHdpdGggR0lNUFeBDhcAAAAMSURBVAjXY/j//z8ABf4C/tzMWecAAAAASUVORK5CYII=")))
-        else:
+            return BLOCK
+        return ALLOW
+    # Same as decide, but remembered in decision_cache.
+    def decision(self, url, urlString, ctype, elementType, firstParty):
+        key = (urlString, elementType, ctype, firstParty)
+        try: return decision_cache.get(key)
+        except KeyError:
+            decision = self.decide(url, urlString, ctype, elementType, firstParty)
+            decision_cache.set(key, decision)
+            return decision
+    def createRequest(self, op, request, device=None):
+        url = request.url()
+        urlString = url.toString()
+        if url.scheme() == "file" and os.path.isdir(os.path.abspath(url.path())):
+            return NetworkReply(self, url, self.GetOperation, directoryListing(url))
+        if url.scheme() == "file" and op == self.GetOperation and isLargeTextFile(os.path.abspath(url.path())):
+            try: return MappedFileReply(self, url, os.path.abspath(url.path()))
+            except: pass
+        if urlString.startswith(filtering.adblock_stats_url):
+            if urlString == filtering.adblock_stats_json_url:
+                return NetworkReply(self, url, self.GetOperation, filtering.adblock_stats_json(), "application/json; charset=UTF-8")
+            elif urlString == filtering.pruned_rules_url:
+                return NetworkReply(self, url, self.GetOperation, filtering.pruned_adblock_rules(), "text/plain; charset=UTF-8")
+            return NetworkReply(self, url, self.GetOperation, filtering.adblock_stats_page())
+        ctype = str(request.header(QNetworkRequest.ContentTypeHeader))
+        elementType = requestType(request, url)
+        # A page being navigated to is its own first party.
+        firstParty = url.host() if elementType == "document" else firstPartyHost(request)
+        decision = self.decision(url, urlString, ctype, elementType, firstParty)
+        if decision is BLOCK:
+            return QNetworkAccessManager.createRequest(self, self.GetOperation, QNetworkRequest(QUrl(blocked_url)))
+        elif decision:
+            return QNetworkAccessManager.createRequest(self, op, QNetworkRequest(QUrl(decision)), device)
+        if op != self.GetOperation:
             return QNetworkAccessManager.createRequest(self, op, request, device)
+        # Reloads skip the hot tier, but what they fetch still goes into it.
+        hot = isinstance(self.httpCache, DiskCache)
+        if hot and not bypassesHotCache(request):
+            entry = hot_cache.get(urlString, lambda name: headerBytes(request.rawHeader(name)))
+            if entry:
+                return HotCacheReply(self, url, entry)
+        coalescable = isCoalescable(request, elementType)
+        key = None
+        if coalescable:
+            key = inflightKey(request)
+            if key in self.inflight:
+                self.coalesced += 1
+                return self.inflight[key].attach(SharedReply(self, request, self.inflight[key]))
+            self.uncoalesced += 1
+        if not url.scheme() in ("http", "https"):
+            return QNetworkAccessManager.createRequest(self, op, request, device)
+        # Qt only lends us the request for the duration of this call.
+        request = QNetworkRequest(request)
+        host = url.host()
+        priority = request_priorities.get(elementType, default_priority)
+        self.scheduled += 1
+        if priority == 0 or (self.active < max_requests and self.activePerHost.get(host, 0) < max_requests_per_host):
+            reply = self.startRequest(request, host)
+            if not coalescable:
+                return reply
+            transfer = InflightTransfer(self, key, reply, hot)
+        else:
+            transfer = InflightTransfer(self, key, hot=hot)
+            self.sequence += 1
+            page = requestPage(request)
+            heapq.heappush(self.queues.setdefault(host, {}).setdefault(page, []), (priority, self.sequence, QueuedRequest(request, host, page, transfer)))
+            self.queueLength += 1
+            self.queuedCount += 1
+            self.maxQueueDepth = max(self.maxQueueDepth, self.queueLength)
+        if coalescable:
+            self.inflight[key] = transfer
+        return transfer.attach(SharedReply(self, request, transfer))
+    # Sends a GET request and takes up a slot until it finishes.
+    def startRequest(self, request, host):
+        reply = QNetworkAccessManager.createRequest(self, self.GetOperation, request, None)
+        self.active += 1
+        self.activePerHost[host] = self.activePerHost.get(host, 0) + 1
+        reply.finished.connect(lambda: self.releaseSlot(host))
+        return reply
+    def releaseSlot(self, host):
+        self.active -= 1
+        self.activePerHost[host] -= 1
+        if not self.activePerHost[host]:
+            del self.activePerHost[host]
+        self.dispatch()
+    # Starts queued requests for as long as there are free slots.
+    def dispatch(self):
+        while self.queueLength and self.active < max_requests:
+            # The visible tab's requests go ahead of background ones.
+            best = None
+            for host, pages in self.queues.items():
+                if self.activePerHost.get(host, 0) >= max_requests_per_host:
+                    continue
+                for page, heap in pages.items():
+                    order = (isBackgroundPage(page),) + heap[0][:2]
+                    if best == None or order < best[0]:
+                        best = (order, host, page)
+            if best == None:
+                break
+            order, host, page = best
+            queued = self.popQueued(host, page)
+            wait = time.time() - queued.queued
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+            queued.transfer.start(self.startRequest(queued.request, queued.host))
+    def popQueued(self, host, page):
+        pages = self.queues[host]
+        queued = heapq.heappop(pages[page])[2]
+        if not pages[page]:
+            del pages[page]
+            if not pages:
+                del self.queues[host]
+        self.queueLength -= 1
+        return queued
+    # Forgets a queued request whose replies were all aborted.
+    def dequeue(self, transfer):
+        for host, pages in list(self.queues.items()):
+            for page, heap in list(pages.items()):
+                kept = [item for item in heap if item[2].transfer is not transfer]
+                if len(kept) == len(heap):
+                    continue
+                self.queueLength -= len(heap) - len(kept)
+                if kept:
+                    heapq.heapify(kept)
+                    pages[page] = kept
+                else:
+                    del pages[page]
+            if not pages:
+                del self.queues[host]
+    def schedulerStats(self):
+        started = self.queuedCount - self.queueLength
+        return {"active": self.active, "queue_depth": self.queueLength, "max_queue_depth": self.maxQueueDepth, "requests": self.scheduled, "queued": self.queuedCount, "average_wait": (self.totalWait / started if started else 0.0), "max_wait": self.maxWait}
+    def inflightStats(self):
+        requests = self.coalesced + self.uncoalesced
+        return {"in_flight": len(self.inflight), "coalesced": self.coalesced, "requests": requests, "hit_rate": (float(self.coalesced) / requests if requests else 0.0)}
 
 # Create global instance of NetworkAccessManager.
 network_access_manager = NetworkAccessManager()
@@ -131,14 +1234,33 @@ incognito_network_access_manager.setCookieJar(incognito_cookie_jar)
 
 # Clear cache.
 def clear_cache():
-    common.trayIcon.showMessage("What cache?", "Nimbus doesn't have a cache.")
+    hot_cache.clear()
+    network_access_manager.httpCache.clear()
+    incognito_network_access_manager.httpCache.clear()
+
+# Applies a changed data/MaximumCacheSize.
+def update_cache_size():
+    network_access_manager.httpCache.setMaximumCacheSize(maximumCacheSize())
+    incognito_network_access_manager.httpCache.setMaximumCacheSize(maximumCacheSize())
+
+# Counters for requests that shared a download with another one.
+def inflight_stats():
+    return {"normal": network_access_manager.inflightStats(), "incognito": incognito_network_access_manager.inflightStats()}
+
+# Queue depth and wait time of the request schedulers.
+def scheduler_stats():
+    return {"normal": network_access_manager.schedulerStats(), "incognito": incognito_network_access_manager.schedulerStats()}
+
+# Hit, miss and size counters for every cache.
+def cache_stats():
+    return {"memory": hot_cache.stats(), "disk": network_access_manager.httpCache.stats(), "incognito": incognito_network_access_manager.httpCache.stats()}
 
 # This function checks whether the system is connected to a network interface.
 # It is used by Nimbus to determine whether the system is connected to the
 # Internet, though this is technically a misuse of it.
 # Ported from http://stackoverflow.com/questions/2475266/verfiying-the-network-connection-using-qt-4-4
 # and http://stackoverflow.com/questions/13533710/pyqt-convert-enum-value-to-key
-def isConnectedToNetwork():
+def scanInterfaces():
     ifaces = QNetworkInterface.allInterfaces()
     result = False
     for iface in ifaces:
@@ -148,3 +1270,62 @@ def isConnectedToNetwork():
                     result = True
                     break
     return result
+
+# How often the network interfaces are checked, in milliseconds.
+connectivity_interval = 10000
+
+# Keeps track of whether the system is online, so that the network
+# interfaces are checked every few seconds (or when Qt reports a change)
+# instead of every time somebody asks.
+# onlineChanged is only emitted when the state actually changes.
+class ConnectivityMonitor(QObject):
+    onlineChanged = Signal(bool)
+    def __init__(self, parent=None):
+        super(ConnectivityMonitor, self).__init__(parent)
+        self.online = scanInterfaces()
+        self.checks = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(connectivity_interval)
+        try:
+            self.configurationManager = QNetworkConfigurationManager(self)
+            self.configurationManager.onlineStateChanged.connect(self.refresh)
+            self.configurationManager.configurationChanged.connect(self.refresh)
+        except:
+            self.configurationManager = None
+    def isOnline(self):
+        return self.online
+    def refresh(self, *args):
+        self.checks += 1
+        online = scanInterfaces()
+        if online != self.online:
+            self.online = online
+            self.onlineChanged.emit(online)
+        return online
+
+# The monitor needs a running QApplication for its timer, so it's made
+# by startConnectivityMonitor once nimbus.main has created one.
+connectivity_monitor = None
+connectivity_callbacks = []
+
+def startConnectivityMonitor():
+    global connectivity_monitor
+    if connectivity_monitor == None:
+        connectivity_monitor = ConnectivityMonitor(QCoreApplication.instance())
+        for callback in connectivity_callbacks:
+            connectivity_monitor.onlineChanged.connect(callback)
+    return connectivity_monitor
+
+# Calls callback(online) whenever the connectivity state changes, once the
+# monitor is running.
+def connectOnlineChanged(callback):
+    connectivity_callbacks.append(callback)
+    if connectivity_monitor != None:
+        connectivity_monitor.onlineChanged.connect(callback)
+
+# Returns the last known connectivity state, or checks the interfaces if
+# the monitor isn't running yet.
+def isConnectedToNetwork():
+    if connectivity_monitor == None:
+        return scanInterfaces()
+    return connectivity_monitor.isOnline()
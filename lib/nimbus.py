@@ -110,11 +110,13 @@ def prepareQuit():
     try: os.remove(settings.crash_file)
     except: pass
     saveSession()
-    settings.settings.hardSync()
+    settings.settings.flush()
     data.saveData()
-    data.data.hardSync()
+    data.data.flush()
     filtering.adblock_filter_loader.quit()
     filtering.adblock_filter_loader.wait()
+    filtering.subscription_updater.quit()
+    filtering.subscription_updater.wait()
     server_thread.httpd.shutdown()
     server_thread.quit()
     server_thread.wait()
@@ -187,6 +189,9 @@ def main(argv):
     app.setApplicationName(common.app_name + "/" + common.app_version)
     app.installTranslator(translate.translator)
 
+    # Start watching for the system going online or offline.
+    network.startConnectivityMonitor()
+
     # We want Nimbus to stay open when the last window is closed,
     # so we set this.
     app.setQuitOnLastWindowClosed(False)
@@ -268,6 +273,11 @@ def main(argv):
     # Load adblock rules.
     filtering.adblock_filter_loader.start()
 
+    # Check filter list subscriptions now and every hour.
+    subscriptionTimer = QTimer(timeout=filtering.subscription_updater.start, parent=QCoreApplication.instance())
+    subscriptionTimer.start(3600000)
+    filtering.subscription_updater.start()
+
     if not os.path.isdir(settings.extensions_folder):
         try: shutil.copytree(common.extensions_folder,\
                              settings.extensions_folder)
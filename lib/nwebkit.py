@@ -60,7 +60,7 @@ def addHistoryItem(url, title=None):
     if settings.setting_to_bool("data/RememberHistory"):
         url = url.split("#")[0]
         if len(url) <= settings.setting_to_int("data/MaximumURLLength"):
-            data.history[url] = {"title": title, "last_visited" : QDateTime.currentDateTime().toMSecsSinceEpoch()}
+            data.history.add(url, title, QDateTime.currentDateTime().toMSecsSinceEpoch())
 
 # Progress bar used for downloads.
 # This was ripped off of Ryouko.
@@ -132,27 +132,16 @@ class FullScreenRequester(QObject):
     def setFullScreen(self, fullscreen=False):
         self.fullScreenRequested.emit(fullscreen)
 
-isOnlineTimer = QTimer()
+# Tells every open page when the system goes online or offline.
+# Pages get navigator.onLine in tweakDOM, so this only runs when
+# network.connectivity_monitor sees the state actually change.
+def setNavigatorOnline(online):
+    script = "if (window.nimbus) { window.nimbus.onLine = %s; document.dispatchEvent(window.nimbus.%s); }" % (str(bool(online)).lower(), "onLineEvent" if online else "offLineEvent")
+    for webview in common.webviews:
+        try: webview.page().mainFrame().evaluateJavaScript(script)
+        except: traceback.print_exc()
 
-def setNavigatorOnline():
-    online = bool(network.isConnectedToNetwork())
-    script = "window.navigator.onLine = " + str(online).lower() + ";"
-    if online:
-        for window in browser.windows:
-            for tab in range(window.tabWidget().count()):
-                try:
-                    window.tabWidget().widget(tab).page().mainFrame().evaluateJavaScript(script)
-                    window.tabWidget().widget(tab).page().mainFrame().evaluateJavaScript("document.dispatchEvent(window.nimbus.onLineEvent);")
-                except:
-                    traceback.print_exc()
-    else:
-        for window in browser.windows:
-            for tab in range(window.tabWidget().count()):
-                try:
-                    window.tabWidget().widget(tab).page().mainFrame().evaluateJavaScript(script)
-                    window.tabWidget().widget(tab).page().mainFrame().evaluateJavaScript("document.dispatchEvent(window.nimbus.offLineEvent);")
-                except:
-                    traceback.print_exc()
+network.connectOnlineChanged(setNavigatorOnline)
 
 # Custom WebPage class with support for filesystem.
 class WebPage(QWebPage):
@@ -188,6 +177,10 @@ class WebPage(QWebPage):
         # improve HTML5 support.
         self.mainFrame().javaScriptWindowObjectCleared.connect(self.tweakDOM)
 
+        # Element hiding rules have to be in place before the new page is
+        # laid out, so they're applied as soon as the main frame's URL changes.
+        self.mainFrame().urlChanged.connect(self.applyUserStyleSheet)
+
         # Connect loadFinished to checkForNavigatorGeolocation and loadUserScripts.
         self.loadFinished.connect(self.doRedirectHack)
         self.loadFinished.connect(self.checkForNavigatorGeolocation)
@@ -198,14 +191,13 @@ class WebPage(QWebPage):
         # Custom userscript.
         self.userScript = ""
 
+        # Stylesheet set by whoever created the page, such as an extension
+        # sidebar. applyUserStyleSheet leaves it alone.
+        self.customStyleSheet = None
+
         # This stores the user agent.
         self._userAgent = ""
 
-        # Start self.isOnlineTimer.
-        if not isOnlineTimer.isActive():
-            isOnlineTimer.timeout.connect(setNavigatorOnline)
-            isOnlineTimer.start(5000)
-
         # Set user agent to default value.
         self.setUserAgent()
 
@@ -375,15 +367,6 @@ class WebPage(QWebPage):
     def loadUserScripts(self):
         if not self._userScriptsLoaded:
             self._userScriptsLoaded = True
-            if settings.setting_to_bool("content/HostFilterEnabled") or settings.setting_to_bool("content/AdblockEnabled"):
-                self.mainFrame().evaluateJavaScript("""var __NimbusAdRemoverQueries = %s;
-for (var i=0; i<__NimbusAdRemoverQueries.length; i++) {
-    var cl = document.querySelectorAll(__NimbusAdRemoverQueries[i]);
-    for (var j=0; j<cl.length; j++) {
-        cl[j].style.display = "none";
-    }
-}
-delete __NimbusAdRemoverQueries;""" % (settings.adremover_filters,))
             self.mainFrame().evaluateJavaScript(self.userScript)
             for userscript in settings.userscripts:
                 if userscript["start"] == True:
@@ -400,6 +383,24 @@ delete __NimbusAdRemoverQueries;""" % (settings.adremover_filters,))
                     except:
                         pass
 
+    # Hides ads on the page through its user stylesheet, which combines
+    # user.css with the element hiding rules and Ad Remover filters that
+    # apply to the page's host.
+    def setCustomStyleSheet(self, url):
+        self.customStyleSheet = url
+        self.settings().setUserStyleSheetUrl(url)
+
+    def applyUserStyleSheet(self, url=None):
+        if self.customStyleSheet != None:
+            return
+        if type(url) is not QUrl:
+            url = self.mainFrame().url()
+        stylesheet = filtering.user_stylesheet_url(url.host())
+        if stylesheet:
+            self.settings().setUserStyleSheetUrl(QUrl(stylesheet))
+        else:
+            self.settings().setUserStyleSheetUrl(QUrl.fromUserInput(settings.user_css))
+
     # Returns user agent string.
     def userAgentForUrl(self, url):
         override = data.userAgentForUrl(url.authority())
@@ -480,6 +481,8 @@ delete __NimbusAdRemoverQueries;""" % (settings.adremover_filters,))
                                             "window.nimbus.onLineEvent.initEvent('online',true,false);")
         self.mainFrame().evaluateJavaScript("window.nimbus.offLineEvent = document.createEvent('Event');\n" + \
                                             "window.nimbus.offLineEvent.initEvent('offline',true,false);")
+        self.mainFrame().evaluateJavaScript("window.nimbus.onLine = %s;\n" % (str(bool(network.isConnectedToNetwork())).lower(),) + \
+                                            "try { Object.defineProperty(window.navigator, 'onLine', {get: function() { return window.nimbus.onLine; }, configurable: true}); } catch (e) {}")
 
     # Creates Qt-based plugins.
     # One plugin pertains to the settings dialog,
@@ -712,8 +715,7 @@ class WebView(QWebView):
 
     def updateHistoryTitle(self, title):
         url = self.url().toString().split("#")[0]
-        if url in data.history.keys():
-            data.history[url]["title"] = (title if len(title) > 0 else tr("(Untitled)"))
+        data.history.setTitle(url, (title if len(title) > 0 else tr("(Untitled)")))
 
     def setUrlText(self, text, emit=True):
         if type(text) is QUrl:
@@ -5,8 +5,26 @@
 
 import os
 import json
+import atexit
+import weakref
+import threading
 import paths
 
+# How long sync() waits for more changes before writing, in seconds.
+sync_delay = 1.0
+
+# Every QSettings object, so that writes still waiting on a timer can be
+# made before the interpreter exits. The timers are daemon threads and
+# would otherwise be dropped, losing the last changes of short scripts.
+instances = weakref.WeakSet()
+
+def flushAll():
+    for instance in list(instances):
+        try: instance.flush()
+        except: pass
+
+atexit.register(flushAll)
+
 class QSettings(object):
     IniFormat = None
     UserScope = None
@@ -22,6 +40,19 @@ class QSettings(object):
             os.makedirs(self.fulldirname)
         self.fname = fname + ".json"
         self.tables = {}
+        # Keys changed since the last write, and the timer that will write
+        # them. self.lock guards both, and self.writeLock makes sure only
+        # one write happens at a time.
+        self.dirty = set()
+        self.timer = None
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+        # Parsed values, by key and then by the kind of parsing, and the
+        # functions to call when a value changes.
+        self.cache = {}
+        self.listeners = []
+        instances.add(self)
         if os.path.isfile(self.fileName()):
             try: f = open(self.fileName(), "r")
             except: pass
@@ -32,21 +63,103 @@ class QSettings(object):
     def fileName(self):
         return os.path.join(self.fulldirname, self.fname)
     def setValue(self, key, value):
-        self.tables[key] = value
+        with self.lock:
+            # Lists and dicts may have been changed in place, so only
+            # plain values are compared.
+            if key in self.tables and isinstance(value, (str, int, float, bool, type(None))) and self.tables[key] == value:
+                return
+            self.tables[key] = value
+            self.dirty.add(key)
+            self.cache.pop(key, None)
+        self.notify(key, value)
     def value(self, key):
         try: return self.tables[key]
         except: return None
+    def remove(self, key):
+        with self.lock:
+            if not key in self.tables:
+                return
+            del self.tables[key]
+            self.dirty.add(key)
+            self.cache.pop(key, None)
+        self.notify(key, None)
+    # Returns parse(value(key)), parsing it only the first time it's asked
+    # for after it changes. kind tells apart different ways of parsing the
+    # same key.
+    def cachedValue(self, key, kind, parse):
+        try: return self.cache[key][kind]
+        except KeyError: pass
+        value = parse(self.value(key))
+        self.cache.setdefault(key, {})[kind] = value
+        return value
+    # callback(key, value) is called whenever a value changes.
+    def addListener(self, callback):
+        self.listeners.append(callback)
+    def removeListener(self, callback):
+        try: self.listeners.remove(callback)
+        except: pass
+    def notify(self, key, value):
+        for callback in list(self.listeners):
+            try: callback(key, value)
+            except: pass
+    def isDirty(self):
+        return bool(self.dirty)
     def allKeys(self):
         return sorted([key for key in self.tables.keys()])
+    # Schedules a write. Calls made in quick succession are coalesced
+    # into one write, which happens on a timer thread.
     def sync(self):
         if self.portable:
-            pass
-        else:
-            self.hardSync()
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            self.schedule()
+    # Starts the write timer if it isn't running. self.lock must be held.
+    def schedule(self):
+        if self.timer:
+            return
+        self.timer = threading.Timer(sync_delay, self.write)
+        self.timer.daemon = True
+        self.timer.start()
+    # Writes straight away if anything has changed.
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        self.write()
     def hardSync(self):
-        try: f = open(self.fileName(), "w")
-        except: pass
-        else:
-            try: json.dump(self.tables, f)
-            except: pass
-            f.close()
+        self.flush()
+    # Writes the settings to a temporary file and swaps it in, so that a
+    # crash halfway through doesn't leave a truncated file behind.
+    def write(self):
+        with self.writeLock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return
+                dirty = self.dirty
+                self.dirty = set()
+                try: content = json.dumps(self.tables)
+                except:
+                    # Try again later; the value may be fixed by then.
+                    self.dirty |= dirty
+                    self.schedule()
+                    return
+            tmp = self.fileName() + ".tmp"
+            try:
+                f = open(tmp, "w")
+                try:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                os.replace(tmp, self.fileName())
+            except:
+                with self.lock:
+                    self.dirty |= dirty
+                    self.schedule()
+                return
+            self.writes += 1
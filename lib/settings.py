@@ -63,6 +63,8 @@ default_settings = {"proxy/Type": "None",
                     "content/FrameFlatteningEnabled": False,
                     "content/PluginsEnabled": True,
                     "content/AdblockEnabled": False,
+                    "content/AdblockProfilingEnabled": False,
+                    "content/AdblockSubscriptions": "[]",
                     "content/AdremoverFilters": """["#guser > nobr > #gbe", "#HOME_TOP_RIGHT_BOXAD", "#TOP_RIGHT_BOXAD", "#WikiaTopAds", ".headerads", ".home-top-right-ads", ".home_right_column", ".SelfServeUrl", ".adcode_container", ".ad-blocking-makes-fella-confused", "div[id*='adcode']", "div[id*='div-gpt-ad']", "div[class*='sleekadbubble']", "div[class*='gr-adcast']", "div[class*='textbanner-ad']", "div[class*='dp-ad-visible']", "div[class*='partial-ad']", "iframe[src*='/ads/']", "div[style='text-align: center; margin: 0px auto; width:160px; height:600px; position:relative;']", "div[id*='pw_adbox']", "#headerad"]""",
                     "content/HostFilterEnabled": True,
                     "content/ReplaceHTML5MediaTagsWithEmbedTags": (True if "win" in sys.platform else False),
@@ -104,20 +106,39 @@ for setting, value in default_settings.items():
 
 settings.hardSync()
 
-def setting_to_bool(value=""):
-    try: return bool(eval(str(settings.value(value)).title()))
+# Settings are parsed once and cached until they change.
+# Values may be stored as real booleans, numbers and lists, or as strings
+# of them.
+def parse_bool(value):
+    if isinstance(value, (bool, int, float)):
+        return bool(value)
+    value = str(value).strip().lower()
+    if value == "true":
+        return True
+    try: return float(value) != 0
     except: return False
 
-def setting_to_int(value=""):
-    try: return int(settings.value(value))
+def parse_int(value):
+    try: return int(value)
     except: return 0
 
+def parse_list(value):
+    if type(value) is list:
+        return value
+    try:
+        value = json.loads(value)
+        return value if type(value) is list else []
+    except: return []
+
+def setting_to_bool(value=""):
+    return settings.cachedValue(value, "bool", parse_bool)
+
+def setting_to_int(value=""):
+    return settings.cachedValue(value, "int", parse_int)
+
+# Returns a copy, so that callers can change it freely.
 def setting_to_list(value=""):
-    if type(settings.value(value)) is list:
-        return settings.value(value)
-    else:
-        try: return json.loads(settings.value(value))
-        except: return []
+    return list(settings.cachedValue(value, "list", parse_list))
 
 pyqt4 = setting_to_bool("general/ForcePyQt4")
 
@@ -16,6 +16,7 @@ import settings
 import browser
 import custom_widgets
 import filtering
+import network
 import data
 import clear_history_dialog
 from translate import tr
@@ -408,12 +409,11 @@ class DataSettingsPanel(SettingsPanel):
         self.layout().addWidget(self.maximumURLLengthRow)
 
         # Maximum cache size spinbox.
-        # The cache is gone because it fucks Nimbus with a chainsaw.
-        #self.maximumCacheSizeRow = custom_widgets.SpinBoxRow(tr("Maximum cache size:"), self)
-        #self.maximumCacheSizeRow.expander.setText(tr("MB"))
-        #self.maximumCacheSize = self.maximumCacheSizeRow.spinBox
-        #self.maximumCacheSize.setMaximum(20000)
-        #self.layout().addWidget(self.maximumCacheSizeRow)
+        self.maximumCacheSizeRow = custom_widgets.SpinBoxRow(tr("Maximum cache size:"), self)
+        self.maximumCacheSizeRow.expander.setText(tr("MB"))
+        self.maximumCacheSize = self.maximumCacheSizeRow.spinBox
+        self.maximumCacheSize.setMaximum(20000)
+        self.layout().addWidget(self.maximumCacheSizeRow)
 
         # Checkbox to toggle geolocation.
         self.geolocationToggle = QCheckBox(tr("Enable geo&location"), self)
@@ -456,7 +456,7 @@ class DataSettingsPanel(SettingsPanel):
         self.layout().addWidget(custom_widgets.Expander(self))
     def loadSettings(self):
         self.maximumURLLength.setValue(settings.setting_to_int("data/MaximumURLLength"))
-        #self.maximumCacheSize.setValue(settings.setting_to_int("data/MaximumCacheSize"))
+        self.maximumCacheSize.setValue(settings.setting_to_int("data/MaximumCacheSize"))
         self.rememberHistoryToggle.setChecked(settings.setting_to_bool("data/RememberHistory"))
         self.geolocationToggle.setChecked(settings.setting_to_bool("network/GeolocationEnabled"))
         self.geolocationWhitelist.clear()
@@ -467,7 +467,8 @@ class DataSettingsPanel(SettingsPanel):
             self.geolocationBlacklist.addItem(url)
     def saveSettings(self):
         settings.settings.setValue("data/MaximumURLLength", self.maximumURLLength.value())
-        #settings.settings.setValue("data/MaximumCacheSize", self.maximumCacheSize.value())
+        settings.settings.setValue("data/MaximumCacheSize", self.maximumCacheSize.value())
+        network.update_cache_size()
         settings.settings.setValue("data/RememberHistory", self.rememberHistoryToggle.isChecked())
         settings.settings.setValue("network/GeolocationEnabled", self.geolocationToggle.isChecked())
         data.geolocation_whitelist = [self.geolocationWhitelist.item(authority).text() for authority in range(0, self.geolocationWhitelist.count())]
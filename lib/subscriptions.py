@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+
+# ----------------
+# subscriptions.py
+# ----------------
+# Author:      Daniel Sim (foxhead128)
+# License:     See LICENSE.md for more details.
+# Description: Keeps Adblock Plus filter list subscriptions up to date.
+#              Each list is downloaded into the adblock folder, and its
+#              ETag, Last-Modified date, version and expiry time are kept
+#              in a JSON file so that it is only fetched again once it has
+#              expired, and then with a conditional request.
+
+import os
+import re
+import json
+import time
+import hashlib
+import email.utils
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+# How long a list is kept before it is checked again, unless it says
+# otherwise with an "! Expires:" comment or an Expires header.
+default_expiry = 86400
+minimum_expiry = 3600
+maximum_expiry = 14 * 86400
+
+# How long to wait before trying again after a failed download.
+retry_delay = 3600
+
+RE_EXPIRES = re.compile(r"^!\s*Expires\s*:\s*(\d+)\s*(day|hour)", re.I)
+RE_VERSION = re.compile(r"^!\s*Version\s*:\s*(\S+)", re.I)
+
+# Reads the "! Expires:" and "! Version:" comments at the top of a list.
+def parse_list_header(lines):
+    expires = None
+    version = None
+    for line in lines[:50]:
+        if not line.startswith("!") and not line.startswith("["):
+            break
+        match = RE_EXPIRES.match(line)
+        if match:
+            expires = int(match.group(1)) * (86400 if match.group(2).lower() == "day" else 3600)
+        match = RE_VERSION.match(line)
+        if match:
+            version = match.group(1)
+    return expires, version
+
+# Returns the lines that are in new_lines but not old_lines, and the lines
+# that are in old_lines but not new_lines.
+def diff_rules(old_lines, new_lines):
+    old = set(old_lines)
+    new = set(new_lines)
+    return [line for line in new_lines if line not in old], [line for line in old_lines if line not in new]
+
+def read_lines(fname):
+    try: f = open(fname, "r")
+    except: return []
+    try: return [line.rstrip("\n") for line in f.readlines()]
+    except: return []
+    finally: f.close()
+
+class Subscription(object):
+    def __init__(self, url, fname):
+        super(Subscription, self).__init__()
+        self.url = url
+        self.fname = fname
+        self.etag = None
+        self.last_modified = None
+        self.version = None
+        self.expires = 0
+        self.checked = 0
+    def to_dict(self):
+        return {"url": self.url, "fname": self.fname, "etag": self.etag, "last_modified": self.last_modified, "version": self.version, "expires": self.expires, "checked": self.checked}
+    @classmethod
+    def from_dict(cls, data):
+        self = cls(data["url"], data["fname"])
+        for key in ("etag", "last_modified", "version", "expires", "checked"):
+            if key in data:
+                setattr(self, key, data[key])
+        return self
+    def is_due(self, now=None):
+        return (time.time() if now == None else now) >= self.expires
+
+class SubscriptionManager(object):
+    def __init__(self, state_file, folder):
+        super(SubscriptionManager, self).__init__()
+        self.state_file = state_file
+        self.folder = folder
+        self.subscriptions = []
+        self.load()
+
+    def load(self):
+        try: f = open(self.state_file, "r")
+        except: return
+        try: self.subscriptions = [Subscription.from_dict(data) for data in json.load(f)]
+        except: pass
+        f.close()
+
+    def save(self):
+        tmp = self.state_file + ".tmp"
+        try: f = open(tmp, "w")
+        except: return
+        try: json.dump([subscription.to_dict() for subscription in self.subscriptions], f)
+        except:
+            f.close()
+            return
+        f.close()
+        try: os.replace(tmp, self.state_file)
+        except: pass
+
+    def find(self, url):
+        for subscription in self.subscriptions:
+            if subscription.url == url:
+                return subscription
+        return None
+
+    def subscribe(self, url):
+        subscription = self.find(url)
+        if not subscription:
+            fname = os.path.join(self.folder, "subscription-%s.txt" % (hashlib.sha1(url.encode("utf-8")).hexdigest()[:12],))
+            subscription = Subscription(url, fname)
+            self.subscriptions.append(subscription)
+        return subscription
+
+    # Drops a subscription and its downloaded list.
+    # Returns the rules the list held.
+    def unsubscribe(self, url):
+        subscription = self.find(url)
+        if not subscription:
+            return []
+        self.subscriptions.remove(subscription)
+        lines = read_lines(subscription.fname)
+        try: os.remove(subscription.fname)
+        except: pass
+        return lines
+
+    # Makes the subscriptions match a list of URLs.
+    # Returns (old rules, []) for every list that was dropped.
+    def sync(self, urls):
+        changes = []
+        for subscription in list(self.subscriptions):
+            if subscription.url not in urls:
+                changes.append((self.unsubscribe(subscription.url), []))
+        for url in urls:
+            self.subscribe(url)
+        return changes
+
+    def due(self, now=None):
+        return [subscription for subscription in self.subscriptions if subscription.is_due(now)]
+
+    # Downloads a list if it has changed since it was last fetched.
+    # Returns (old rules, new rules), or None if it hasn't changed.
+    def update(self, subscription, timeout=30):
+        now = time.time()
+        subscription.checked = now
+        request = Request(subscription.url)
+        if subscription.etag and os.path.exists(subscription.fname):
+            request.add_header("If-None-Match", subscription.etag)
+        if subscription.last_modified and os.path.exists(subscription.fname):
+            request.add_header("If-Modified-Since", subscription.last_modified)
+        try:
+            response = urlopen(request, timeout=timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                # The list hasn't changed, so its own "! Expires:" comment
+                # still holds.
+                expires, version = parse_list_header(read_lines(subscription.fname))
+                subscription.expires = now + self.expiry(e.headers, expires)
+                return None
+            subscription.expires = now + retry_delay
+            raise
+        except:
+            subscription.expires = now + retry_delay
+            raise
+        try: content = response.read().decode("utf-8", "replace")
+        finally: response.close()
+        new_lines = content.splitlines()
+        if not new_lines or not new_lines[0].startswith("[Adblock"):
+            subscription.expires = now + retry_delay
+            raise ValueError("%s is not an Adblock Plus filter list" % (subscription.url,))
+        expires, subscription.version = parse_list_header(new_lines)
+        subscription.expires = now + self.expiry(response.headers, expires)
+        subscription.etag = response.headers.get("ETag")
+        subscription.last_modified = response.headers.get("Last-Modified")
+        old_lines = read_lines(subscription.fname)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        tmp = subscription.fname + ".tmp"
+        f = open(tmp, "w")
+        try: f.write("\n".join(new_lines) + "\n")
+        finally: f.close()
+        os.replace(tmp, subscription.fname)
+        return old_lines, new_lines
+
+    # Seconds until a list should be checked again. The list's own
+    # "! Expires:" comment wins over the Expires header.
+    def expiry(self, headers, expires):
+        if expires == None and headers != None and headers.get("Expires"):
+            try: expires = email.utils.mktime_tz(email.utils.parsedate_tz(headers.get("Expires"))) - time.time()
+            except: expires = None
+        if expires == None:
+            expires = default_expiry
+        return min(max(expires, minimum_expiry), maximum_expiry)